@@ -0,0 +1,192 @@
+"""
+benchmark.py: measures how the forward pass, gradient computation and
+training of the quantum neural network in qnn.py scale with the number of
+layers, the batch size and the number of shots, and writes the results to
+a JSON or CSV file so they can be compared between versions.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from qiskit import Aer
+import numpy as np
+
+from qnn import EXACT, convertDataToAngles, forwardPass, batchForwardPass
+from qnn import computeGradient, computeBatchGradient, updateParams
+from qnn import trainNetwork
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchresults import writeResults
+
+
+def loadData():
+    """
+    Returns the encoding angles and labels of the IRIS dataset used by
+    qnn.py.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'processedIRISData.csv')
+    data = np.genfromtxt(path, delimiter=',')
+    features = np.array([convertDataToAngles(i) for i in data[:, 0:4]])
+    return features, data[:, -1]
+
+
+def timeCall(function, repeats):
+    """
+    Calls function repeats times and returns the median wall clock time
+    of a single call, in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def timeEpoch(params, bias, data, labels, batchSize, backend, shots):
+    """
+    Returns the time taken by one pass of minibatch gradient descent over
+    data, using the same updates as trainNetwork.
+    """
+    prevParams = np.copy(params)
+    prevBias = bias
+    start = time.perf_counter()
+    for samplePos in range(0, labels.shape[0], batchSize):
+        batchGrads, batchBiasGrad, _ = computeBatchGradient(
+            params, data[samplePos:samplePos + batchSize],
+            labels[samplePos:samplePos + batchSize], bias, backend,
+            shots=shots
+        )
+        params, prevParams = updateParams(
+            params, prevParams, batchGrads, 0.02, 0.9
+        )
+        temp = bias
+        bias += -0.02 * batchBiasGrad + 0.9 * (bias - prevBias)
+        prevBias = temp
+    return time.perf_counter() - start
+
+
+def runBenchmark(backend, layerCounts, batchSizes, shotCounts, repeats,
+                 epochSamples):
+    """
+    Sweeps the number of layers, the batch size and the number of shots,
+    and returns a list of dictionaries holding the measurements for every
+    combination.
+    """
+    data, labels = loadData()
+    epochData = data[:epochSamples]
+    epochLabels = labels[:epochSamples]
+    np.random.seed(1)
+    results = []
+
+    for numLayers in layerCounts:
+        params = np.random.sample((numLayers, 2, 1))
+        bias = 0.01
+
+        for shots in shotCounts:
+            forwardLatency = timeCall(
+                lambda: forwardPass(params, bias, data[0], backend, shots),
+                repeats
+            )
+            gradientLatency = timeCall(
+                lambda: computeGradient(
+                    params, data[0], labels[0], bias, backend, shots
+                ), repeats
+            )
+
+            for batchSize in batchSizes:
+                batch = data[:batchSize]
+                batchLatency = timeCall(
+                    lambda: batchForwardPass(
+                        params, bias, batch, backend, shots
+                    ), repeats
+                )
+                epochTime = timeEpoch(
+                    params, bias, epochData, epochLabels, batchSize,
+                    backend, shots
+                )
+                row = {
+                    'backend': EXACT if backend == EXACT else backend.name(),
+                    'layers': numLayers,
+                    'batchSize': batchSize,
+                    'shots': shots,
+                    'forwardLatency': forwardLatency,
+                    'batchForwardLatency': batchLatency / batchSize,
+                    'circuitsPerSecond': batchSize / batchLatency,
+                    'gradientLatencyPerParam': gradientLatency / params.size,
+                    'epochSamples': epochLabels.shape[0],
+                    'epochTime': epochTime
+                }
+                print(row)
+                results.append(row)
+
+    return results
+
+
+def compareEvalModes(backend, evalSampleSize=25):
+    """
+    Runs trainNetwork once with each way of reporting the loss: the
+    running average of the batch losses only, the loss over the whole
+    training set after every iteration, and the loss over a random
+    subsample of evalSampleSize points after every iteration. Returns a
+    list of dictionaries holding the training time and the final losses
+    of each run.
+    """
+    data, labels = loadData()
+    modes = [('running', None, None), ('full', 1, None),
+             ('sampled', 1, evalSampleSize)]
+    results = []
+
+    for mode, evalEvery, sampleSize in modes:
+        history = []
+        start = time.perf_counter()
+        trainNetwork(data, labels, backend, evalEvery=evalEvery,
+                     evalSampleSize=sampleSize,
+                     callback=lambda metrics, params, bias:
+                     history.append(metrics))
+        row = {
+            'backend': EXACT if backend == EXACT else backend.name(),
+            'evalMode': mode,
+            'trainingTime': time.perf_counter() - start,
+            'runningLoss': history[-1]['runningLoss'],
+            'loss': history[-1].get('loss')
+        }
+        print(row)
+        results.append(row)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark qnn.py.')
+    parser.add_argument('--report', choices=['sweep', 'eval'],
+                        default='sweep',
+                        help='sweep layers, batch sizes and shots, or train '
+                        'once with every loss evaluation mode')
+    parser.add_argument('--backend', default='qasm_simulator',
+                        help="an Aer backend name, or 'exact'")
+    parser.add_argument('--layers', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[1, 5, 25])
+    parser.add_argument('--shots', type=int, nargs='+',
+                        default=[100, 1000])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--epoch-samples', type=int, default=25)
+    parser.add_argument('--eval-sample-size', type=int, default=25)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    if args.backend == EXACT:
+        backend = EXACT
+    else:
+        backend = Aer.get_backend(args.backend)
+
+    if args.report == 'eval':
+        results = compareEvalModes(backend, args.eval_sample_size)
+    else:
+        results = runBenchmark(backend, args.layers, args.batch_sizes,
+                               args.shots, args.repeats, args.epoch_samples)
+    writeResults(results, args.output)
@@ -3,11 +3,33 @@ qnn.py: a small quantum neural network that acts as a binary
 classifier.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
 from qiskit import QuantumRegister, ClassicalRegister
-from qiskit import Aer, execute, QuantumCircuit
-from qiskit.extensions import UnitaryGate
+from qiskit import Aer, QuantumCircuit
+from qiskit.circuit import Parameter
+from qiskit.circuit.library.standard_gates import RYGate
 import numpy as np
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qexecute import cachedExecute, executeTemplate
+
+
+# Parametrized forward pass circuits, keyed by the number of layers
+forwardTemplates = {}
+
+# Parametrized Hadamard test circuits, keyed by the number of layers
+realExpectationTemplates = {}
+
+# Passing this in place of a backend selects the exact statevector engine
+EXACT = 'exact'
+
+XMatrix = np.array([[0., 1.], [1., 0.]])
+ZMatrix = np.array([[1., 0.], [0., -1.]])
+HMatrix = np.array([[1., 1.], [1., -1.]]) / np.sqrt(2)
+
 
 def convertDataToAngles(data):
     """
@@ -45,16 +67,14 @@ def GGate(qc, qreg, params):
     qubit gate of the form
     [cos(α), sin(α)]
     [-sin(α), cos(α)]
+    This is exactly RY(-2α), so the gate is returned as a
+    native rotation, which also works with unbound Parameters
+    and is controlled without any unitary synthesis.
     """
-    u00 = np.cos(params[0])
-    u01 = np.sin(params[0])
     gateLabel = "G({})".format(
         params[0]
     )
-    GGate = UnitaryGate(np.array(
-        [[u00, u01], [-u01, u00]]
-    ), label=gateLabel)
-    return GGate
+    return RYGate(-2 * params[0], label=gateLabel)
 
 
 def GLayer(qc, qreg, params):
@@ -72,9 +92,7 @@ def CGLayer(qc, qreg, anc, params):
     on the first qubit of the anc register.
     """
     for i in range(2):
-        qc.append(GGate(
-            qc, qreg, params[i]
-        ).control(1), [anc[0], qreg[i]])
+        qc.cry(-2 * params[i][0], anc[0], qreg[i])
 
 
 def CXLayer(qc, qreg, order):
@@ -123,16 +141,16 @@ def generateCU(qc, qreg, anc, params):
         CCXLayer(qc, qreg, anc, i % 2)
 
 
-def getPrediction(qc, qreg, creg, backend):
+def getPrediction(qc, qreg, creg, backend, shots=1000):
     """
     Returns the probability of measuring the last qubit
     in register qreg as in the |1⟩ state.
     """
     qc.measure(qreg[0], creg[0])
-    job = execute(qc, backend=backend, shots=1000)
+    job = cachedExecute(qc, backend, shots=shots)
     results = job.result().get_counts()
     if '1' in results.keys():
-        return results['1'] / 1000
+        return results['1'] / shots
     else:
         return 0
 
@@ -170,29 +188,202 @@ def accuracy(labels, predictions):
     return acc / labels.shape[0]
 
 
-def forwardPass(params, bias, angles, backend):
+def forwardPass(params, bias, angles, backend, shots=1000):
     """
     Given a parameter set params, input data in the form
     of angles, a bias, and a backend, performs a full
     forward pass on the network and returns the network
-    output.
+    output. The circuit is bound from the same parametrized
+    template as batchForwardPass.
+    """
+    return batchForwardPass(params, bias, [angles], backend, shots)[0]
+
+
+def buildForwardTemplate(numLayers):
     """
+    Builds a forward pass circuit for a network with numLayers
+    layers in which the three encoding angles and the network
+    parameters are left as unbound Parameters. Returns the
+    circuit along with the angle and weight Parameters.
+    """
+    if numLayers in forwardTemplates:
+        return forwardTemplates[numLayers]
+
     qreg = QuantumRegister(2)
     anc = QuantumRegister(1)
     creg = ClassicalRegister(1)
     qc = QuantumCircuit(qreg, anc, creg)
-    encodeData(qc, qreg, angles)
-    generateU(qc, qreg, params)
-    pred = getPrediction(qc, qreg, creg, backend) + bias
-    return pred
+    angleParams = [Parameter('x{}'.format(i)) for i in range(3)]
+    weightParams = np.empty((numLayers, 2, 1), dtype=object)
+    for i in range(numLayers):
+        for j in range(2):
+            weightParams[i, j, 0] = Parameter('w{}_{}'.format(i, j))
+    encodeData(qc, qreg, angleParams)
+    generateU(qc, qreg, weightParams)
+    qc.measure(qreg[0], creg[0])
+    forwardTemplates[numLayers] = (qc, angleParams, weightParams)
+    return forwardTemplates[numLayers]
 
 
-def computeRealExpectation(params1, params2, angles, backend):
+def batchForwardPass(params, bias, data, backend, shots=1000):
     """
-    Computes the real part of the inner product of the
-    quantum states produced by acting with U(θ)
-    characterised by two sets of parameters, params1 and
-    params2.
+    Performs a forward pass for every row of angles in data
+    by binding a single parametrized template, and submits
+    all the bound circuits to backend as one job. Returns
+    an array holding the network output for every row.
+    """
+    if backend == EXACT:
+        return exactForwardPass(params, bias, data)
+
+    qc, angleParams, weightParams = buildForwardTemplate(params.shape[0])
+    weightBinds = {}
+    for i in range(params.shape[0]):
+        for j in range(params.shape[1]):
+            weightBinds[weightParams[i, j, 0]] = params[i, j, 0]
+    bindings = []
+    for angles in data:
+        binding = dict(weightBinds)
+        binding.update(zip(angleParams, angles))
+        bindings.append(binding)
+    results = executeTemplate(qc, bindings, backend, shots=shots).result()
+    preds = np.array([results.get_counts(i).get('1', 0)
+                      for i in range(len(bindings))]) / shots
+    return preds + bias
+
+
+def ryMatrix(theta):
+    """
+    Returns the matrix of RY(θ). If theta is an array, returns
+    a stack of matrices, one for every angle.
+    """
+    c = np.cos(np.asarray(theta) / 2)
+    s = np.sin(np.asarray(theta) / 2)
+    return np.stack([np.stack([c, -s], -1), np.stack([s, c], -1)], -2)
+
+
+def applyExactGate(states, gate, target, controls=()):
+    """
+    Applies a single qubit gate to qubit target of a batch of
+    3 qubit statevectors of shape (N, 8), conditioned on all
+    the qubits in controls being in the |1⟩ state. Qubits 0
+    and 1 are the data register and qubit 2 is the ancilla.
+    gate is either one 2x2 matrix, or N of them, one per state.
+    """
+    psi = states.reshape(-1, 2, 2, 2)
+    axis = 3 - target
+    moved = np.moveaxis(psi, axis, -1)
+    if gate.ndim == 2:
+        out = moved @ gate.T
+    else:
+        out = np.einsum('nij,n...j->n...i', gate, moved)
+    out = np.moveaxis(out, -1, axis)
+    if controls:
+        mask = np.ones((2, 2, 2), dtype=bool)
+        for c in controls:
+            index = [slice(None)] * 3
+            index[2 - c] = 0
+            mask[tuple(index)] = False
+        out = np.where(mask, out, psi)
+    return out.reshape(-1, 8)
+
+
+def exactEncodeData(data):
+    """
+    Returns the statevectors produced by encodeData for every
+    row of angles in data, as an array of shape (N, 8).
+    """
+    data = np.asarray(data)
+    states = np.zeros((data.shape[0], 8))
+    states[:, 0] = 1
+    states = applyExactGate(states, ryMatrix(data[:, 0]), 1)
+    states = applyExactGate(states, ryMatrix(data[:, 1]), 0, (1,))
+    states = applyExactGate(states, XMatrix, 1)
+    states = applyExactGate(states, ryMatrix(data[:, 2]), 0, (1,))
+    return applyExactGate(states, XMatrix, 1)
+
+
+def exactGLayer(states, params, controls=()):
+    """
+    Statevector equivalent of GLayer, or of CGLayer when
+    controls holds the ancilla.
+    """
+    for i in range(2):
+        states = applyExactGate(
+            states, ryMatrix(-2 * params[i][0]), i, controls
+        )
+    return states
+
+
+def exactCXLayer(states, order, controls=()):
+    """
+    Statevector equivalent of CXLayer, or of CCXLayer when
+    controls holds the ancilla.
+    """
+    if order:
+        return applyExactGate(states, XMatrix, 1, (0,) + tuple(controls))
+    else:
+        return applyExactGate(states, XMatrix, 0, (1,) + tuple(controls))
+
+
+def exactGenerateU(states, params, controls=()):
+    """
+    Statevector equivalent of generateU, or of generateCU when
+    controls holds the ancilla.
+    """
+    for i in range(params.shape[0]):
+        states = exactGLayer(states, params[i], controls)
+        states = exactCXLayer(states, i % 2, controls)
+    return states
+
+
+def exactProbability(states, qubit):
+    """
+    Returns the exact probability of measuring the given qubit
+    in the |1⟩ state, for every statevector in states.
+    """
+    psi = np.moveaxis(states.reshape(-1, 2, 2, 2), 3 - qubit, -1)
+    return np.sum(np.abs(psi[..., 1]) ** 2, axis=(1, 2))
+
+
+def exactForwardPass(params, bias, data):
+    """
+    Returns the exact network output for every row of angles
+    in data, computed on statevectors instead of with shots.
+    """
+    states = exactGenerateU(exactEncodeData(data), params)
+    return exactProbability(states, 0) + bias
+
+
+def exactHadamardTestStates(params1, params2, data):
+    """
+    Returns the final statevectors of the circuit built by
+    computeRealExpectation, for every row of angles in data.
+    """
+    states = exactEncodeData(data)
+    states = applyExactGate(states, HMatrix, 2)
+    states = exactGenerateU(states, params1, (2,))
+    states = applyExactGate(states, ZMatrix, 0, (2,))
+    states = applyExactGate(states, XMatrix, 2)
+    states = exactGenerateU(states, params2, (2,))
+    states = applyExactGate(states, XMatrix, 2)
+    return applyExactGate(states, HMatrix, 2)
+
+
+def exactRealExpectation(params1, params2, data):
+    """
+    Returns the exact value estimated by computeRealExpectation
+    for every row of angles in data.
+    """
+    states = exactHadamardTestStates(params1, params2, data)
+    return 2 * (exactProbability(states, 2) - 0.5)
+
+
+def buildRealExpectationCircuit(params1, params2, angles):
+    """
+    Builds the Hadamard test circuit used to estimate the
+    real part of the inner product of the states produced
+    by U(θ) with parameters params1 and params2. Returns the
+    circuit along with its ancilla and classical registers.
     """
     qreg = QuantumRegister(2)
     anc = QuantumRegister(1)
@@ -206,29 +397,357 @@ def computeRealExpectation(params1, params2, angles, backend):
     generateCU(qc, qreg, anc, params2)
     qc.x(anc[0])
     qc.h(anc[0])
+    return qc, anc, creg
+
+
+def buildRealExpectationTemplate(numLayers):
+    """
+    Builds the measured Hadamard test circuit of
+    buildRealExpectationCircuit for a network with numLayers
+    layers, with the three encoding angles and both sets of
+    network parameters left as unbound Parameters. Returns
+    the circuit along with the angle Parameters and the two
+    arrays of weight Parameters.
+    """
+    if numLayers in realExpectationTemplates:
+        return realExpectationTemplates[numLayers]
+
+    angleParams = [Parameter('x{}'.format(i)) for i in range(3)]
+    weightParams = []
+    for k in range(2):
+        weights = np.empty((numLayers, 2, 1), dtype=object)
+        for i in range(numLayers):
+            for j in range(2):
+                weights[i, j, 0] = Parameter('w{}_{}_{}'.format(k, i, j))
+        weightParams.append(weights)
+    qc, anc, creg = buildRealExpectationCircuit(
+        weightParams[0], weightParams[1], angleParams
+    )
+    qc.measure(anc[0], creg[0])
+    realExpectationTemplates[numLayers] = (qc, angleParams, *weightParams)
+    return realExpectationTemplates[numLayers]
+
+
+def exactAdjointGradient(params, data):
+    """
+    Returns the exact partials of the probability of measuring
+    |1⟩ with respect to every entry of params, for every row
+    of angles in data, as an array of shape (N,) + params.shape.
+    Uses one forward sweep and one backward sweep through the
+    layers of U(θ), so the cost is independent of how many
+    parameters there are per layer.
+    """
+    phi = exactGenerateU(exactEncodeData(data), params)
+    lam = applyExactGate(phi, ZMatrix, 0)
+    gradients = np.zeros((phi.shape[0],) + params.shape)
+    for i in reversed(range(params.shape[0])):
+        phi = exactCXLayer(phi, i % 2)
+        lam = exactCXLayer(lam, i % 2)
+        for j in reversed(range(2)):
+            gate = ryMatrix(-2 * params[i, j, 0])
+            phi = applyExactGate(phi, gate.T, j)
+            # dG(α)/dα = G(α + π/2)
+            dPhi = applyExactGate(
+                phi, ryMatrix(-2 * params[i, j, 0] - np.pi), j
+            )
+            gradients[:, i, j, 0] = -np.real(
+                np.sum(np.conj(lam) * dPhi, axis=1)
+            )
+            lam = applyExactGate(lam, gate.T, j)
+    return gradients
+
+
+def computeRealExpectation(params1, params2, angles, backend):
+    """
+    Computes the real part of the inner product of the
+    quantum states produced by acting with U(θ)
+    characterised by two sets of parameters, params1 and
+    params2.
+    """
+    if backend == EXACT:
+        return exactRealExpectation(params1, params2, [angles])[0]
+
+    qc, anc, creg = buildRealExpectationCircuit(params1, params2, angles)
     prob = getPrediction(qc, anc, creg, backend)
     return 2 * (prob - 0.5)
 
 
-def computeGradient(params, angles, label, bias, backend):
+def computeGradient(params, angles, label, bias, backend, shots=1000):
     """
     Given network parameters params, a bias bias, input data
     angles, and a backend, returns a gradient array holding
     partials with respect to every parameter in the array
-    params.
-    """
-    prob = forwardPass(params, bias, angles, backend)
-    gradients = np.zeros_like(params)
-    for i in range(params.shape[0]):
-        for j in range(params.shape[1]):
+    params, the partial with respect to the bias, and the
+    network output. All the Hadamard test circuits are
+    submitted to the backend as a single job. With the exact
+    backend, the partials are computed using
+    exactAdjointGradient instead.
+    """
+    prob = forwardPass(params, bias, angles, backend, shots)
+    if backend == EXACT:
+        biasGrad = (prob + bias - label)
+        return exactAdjointGradient(params, [angles])[0] * biasGrad, \
+            biasGrad, prob
+
+    expectations = estimateRealExpectations(
+        params, angles, backend, np.full(params.shape, shots)
+    )
+    biasGrad = (prob + bias - label)
+    return expectations * biasGrad, biasGrad, prob
+
+
+def estimateRealExpectations(params, angles, backend, shots):
+    """
+    Estimates the real expectation between U(θ) and U(θ) with
+    each parameter shifted by π/2 in turn, spending
+    shots[i, j, 0] shots on the Hadamard test of parameter
+    params[i, j, 0]. The Hadamard tests are bound from a
+    single parametrized template, and circuits that share a
+    shot count are submitted to the backend as a single job.
+    """
+    qc, angleParams, weightParams1, weightParams2 = \
+        buildRealExpectationTemplate(params.shape[0])
+    baseBinding = dict(zip(angleParams, angles))
+    baseBinding.update(zip(weightParams1.ravel(), params.ravel()))
+    expectations = np.zeros_like(params)
+    for shotCount in np.unique(shots):
+        indices = [tuple(index) for index in np.argwhere(shots == shotCount)]
+        bindings = []
+        for index in indices:
             newParams = np.copy(params)
-            newParams[i, j, 0] += np.pi / 2
-            gradients[i, j, 0] = computeRealExpectation(
-                params, newParams, angles, backend
+            newParams[index] += np.pi / 2
+            binding = dict(baseBinding)
+            binding.update(zip(weightParams2.ravel(), newParams.ravel()))
+            bindings.append(binding)
+        results = executeTemplate(
+            qc, bindings, backend, shots=int(shotCount)
+        ).result()
+        for k, index in enumerate(indices):
+            expectations[index] = 2 * (
+                results.get_counts(k).get('1', 0) / shotCount - 0.5
             )
-            newParams[i, j, 0] -= np.pi / 2
-    biasGrad = (prob + bias - label)
-    return gradients * biasGrad, biasGrad
+    return expectations
+
+
+def allocateShots(variances, budget, minShots=16):
+    """
+    Splits a budget of shots across estimates with the given
+    per-shot variances, giving each a share proportional to
+    its standard deviation (Neyman allocation), which
+    minimises the total variance for a fixed budget. Every
+    estimate first gets minShots shots, and the rest of the
+    budget is shared out in multiples of minShots, so the
+    total never exceeds the budget. Raises a ValueError if
+    the budget cannot give every estimate minShots shots.
+    """
+    variances = np.asarray(variances, dtype=float)
+    if budget < variances.size * minShots:
+        raise ValueError(
+            'A budget of {:g} shots cannot give {} estimates {} shots '
+            'each.'.format(budget, variances.size, minShots)
+        )
+    weights = np.sqrt(np.maximum(variances, 1e-6))
+    spare = int((budget - variances.size * minShots) // minShots)
+    extra = spare * weights / np.sum(weights)
+    units = np.floor(extra).astype(int)
+
+    # Hand the multiples lost to rounding down to the largest remainders
+    leftover = spare - np.sum(units)
+    units.flat[np.argsort(units - extra, axis=None)[:leftover]] += 1
+    return (1 + units) * minShots
+
+
+class AdaptiveShotScheduler:
+    """
+    Gradient estimator that spends a fixed budget of shots
+    per training iteration on the forward passes and the
+    Hadamard tests of computeGradient, split across them
+    based on a running estimate of the variance of each
+    estimate. Instances can be passed to trainNetwork as the
+    optimizer. With the exact backend, the gradients are
+    computed by computeBatchGradient without spending shots.
+
+    Every forward pass and Hadamard test gets at least
+    minShots shots, so shotBudget must be at least
+    batchSize * (params.size + 1) * minShots; smaller
+    budgets raise a ValueError.
+
+    After every call, confidenceIntervals holds the half
+    width of the confidence interval of every entry of the
+    batch gradient, biasConfidenceInterval that of the bias
+    gradient, and totalShots the number of shots spent so
+    far, forward passes included.
+    """
+    def __init__(self, shotBudget, minShots=16, decay=0.9, z=1.96):
+        """Set the budget and the allocation settings."""
+        self.shotBudget = shotBudget
+        self.minShots = minShots
+        self.decay = decay
+        self.z = z
+        self.variances = None
+        self.forwardVariance = 0.25
+        self.confidenceIntervals = None
+        self.biasConfidenceInterval = None
+        self.totalShots = 0
+
+    def __call__(self, params, batchData, batchLabels, bias, backend,
+                 pool=None):
+        """Return the batch gradients, like computeBatchGradient."""
+        if backend == EXACT:
+            self.confidenceIntervals = np.zeros(params.shape)
+            self.biasConfidenceInterval = 0.
+            return computeBatchGradient(
+                params, batchData, batchLabels, bias, backend
+            )
+
+        if self.variances is None or self.variances.shape != params.shape:
+            self.variances = np.ones(params.shape)
+
+        # The forward pass is allocated shots as one more estimate
+        numSamples = len(batchData)
+        allShots = allocateShots(
+            np.append(self.variances.ravel(), self.forwardVariance),
+            self.shotBudget / numSamples, self.minShots
+        )
+        shots = allShots[:-1].reshape(params.shape)
+        forwardShots = int(allShots[-1])
+
+        preds = batchForwardPass(
+            params, bias, batchData, backend, forwardShots
+        )
+        biasGrads = preds + bias - np.asarray(batchLabels)
+        expectations = np.array([
+            estimateRealExpectations(params, angles, backend, shots)
+            for angles in batchData
+        ])
+
+        # Each Hadamard test shot is ±1, so its variance is 1 - E²,
+        # and each forward pass shot is Bernoulli in the output
+        shotVariances = 1 - expectations ** 2
+        forwardVariances = (preds - bias) * (1 - preds + bias)
+        self.variances = self.decay * self.variances + \
+            (1 - self.decay) * np.mean(shotVariances, axis=0)
+        self.forwardVariance = self.decay * self.forwardVariance + \
+            (1 - self.decay) * np.mean(forwardVariances)
+
+        # Variance of the product of the two independent estimates
+        expectationVars = shotVariances / shots
+        biasGradVars = (forwardVariances / forwardShots)[:, None, None, None]
+        gradVariances = np.sum(
+            biasGrads[:, None, None, None] ** 2 * expectationVars +
+            expectations ** 2 * biasGradVars +
+            expectationVars * biasGradVars,
+            axis=0
+        ) / numSamples ** 2
+        self.confidenceIntervals = self.z * np.sqrt(gradVariances)
+        self.biasConfidenceInterval = self.z * np.sqrt(
+            np.sum(forwardVariances / forwardShots)
+        ) / numSamples
+        self.totalShots += int(np.sum(allShots)) * numSamples
+
+        batchGrads = np.mean(
+            expectations * biasGrads[:, None, None, None], axis=0
+        )
+        return batchGrads, np.mean(biasGrads), preds
+
+
+def getBackendName(backend):
+    """
+    Returns a picklable name for backend that can be passed
+    to worker processes.
+    """
+    if backend == EXACT:
+        return EXACT
+    return backend.name()
+
+
+def getBackend(backendName):
+    """
+    Returns the backend associated with a name produced by
+    getBackendName.
+    """
+    if backendName == EXACT:
+        return EXACT
+    return Aer.get_backend(backendName)
+
+
+def gradientWorker(args):
+    """
+    Computes the gradient for one sample inside a worker
+    process. args holds the arguments of computeGradient,
+    with the backend replaced by its name.
+    """
+    params, angles, label, bias, backendName, shots = args
+    return computeGradient(
+        params, angles, label, bias, getBackend(backendName), shots
+    )
+
+
+def computeBatchGradient(params, batchData, batchLabels, bias, backend,
+                         pool=None, shots=1000):
+    """
+    Returns the gradients with respect to params and the bias,
+    averaged over the samples in batchData, along with the
+    network outputs for the batch. If a process pool is
+    passed in, the samples are spread across its workers.
+    With the exact backend the whole batch is differentiated
+    at once instead.
+    """
+    if backend == EXACT:
+        preds = exactForwardPass(params, bias, batchData)
+        biasGrads = preds + bias - np.asarray(batchLabels)
+        grads = exactAdjointGradient(params, batchData)
+        return np.mean(grads * biasGrads[:, None, None, None], axis=0), \
+            np.mean(biasGrads), preds
+
+    if pool is None:
+        results = [computeGradient(
+            params, angles, label, bias, backend, shots
+        ) for angles, label in zip(batchData, batchLabels)]
+    else:
+        backendName = getBackendName(backend)
+        results = list(pool.map(gradientWorker, [
+            (params, angles, label, bias, backendName, shots)
+            for angles, label in zip(batchData, batchLabels)
+        ]))
+
+    batchGrads = np.zeros_like(params)
+    batchBiasGrad = 0
+    preds = []
+    for grads, biasGrad, prob in results:
+        batchGrads += grads / len(results)
+        batchBiasGrad += biasGrad / len(results)
+        preds.append(prob)
+    return batchGrads, batchBiasGrad, np.array(preds)
+
+
+def spsaGradient(params, batchData, batchLabels, bias, backend, pool=None,
+                 perturbation=0.1):
+    """
+    Estimates the gradients with respect to params and the
+    bias over the samples in batchData using simultaneous
+    perturbation (SPSA). Every parameter is shifted by
+    ±perturbation at once along a random direction, so only
+    two forward passes per sample are needed, no matter how
+    many parameters there are. Takes the same arguments as
+    computeBatchGradient, so it can be passed to trainNetwork
+    as the optimizer.
+    """
+    labels = np.asarray(batchLabels)
+    direction = np.random.choice([-1, 1], size=params.shape)
+    plusPreds = batchForwardPass(
+        params + perturbation * direction, bias, batchData, backend
+    )
+    minusPreds = batchForwardPass(
+        params - perturbation * direction, bias, batchData, backend
+    )
+    # The same residual, prob + bias - label, as computeGradient
+    lossDiff = ((plusPreds + bias - labels) ** 2 -
+                (minusPreds + bias - labels) ** 2) / 2
+    batchGrads = np.mean(lossDiff) / (2 * perturbation) * direction
+    preds = (plusPreds + minusPreds) / 2
+    batchBiasGrad = np.mean(preds + bias - labels)
+    return batchGrads, batchBiasGrad, preds
 
 
 def updateParams(params, prevParams, grads, learningRate, momentum):
@@ -242,13 +761,65 @@ def updateParams(params, prevParams, grads, learningRate, momentum):
     return paramsNew, params
 
 
-def trainNetwork(data, labels, backend):
+def trainNetwork(data, labels, backend, numWorkers=1,
+                 optimizer=computeBatchGradient, evalEvery=None,
+                 evalSampleSize=None, callback=None):
     """
     Train a quantum neural network on inputs data and
     labels, using backend backend. Returns the parameters
-    learned.
+    and bias learned. Gradients for the samples in a batch are
+    computed in parallel when numWorkers is greater than 1.
+    optimizer estimates the batch gradients, and can be
+    computeBatchGradient (parameter shift), spsaGradient, or
+    any function with the same signature.
+
+    By default the only loss reported is a running average of
+    the losses of the batches seen so far, which needs no
+    extra circuits. If evalEvery is set, the loss over the
+    training set is also evaluated every evalEvery iterations,
+    on a random subsample of evalSampleSize points if given.
+    callback, if given, is called after every iteration with
+    a dictionary of metrics, the parameters and the bias.
+    """
+    if numWorkers > 1:
+        # Forking a process that has already run a simulator job can
+        # deadlock on the simulator's threads, so workers are spawned
+        with ProcessPoolExecutor(
+                numWorkers,
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+            return runTraining(data, labels, backend, optimizer, evalEvery,
+                               evalSampleSize, callback, pool)
+    return runTraining(data, labels, backend, optimizer, evalEvery,
+                       evalSampleSize, callback)
+
+
+def evaluateLoss(params, bias, data, labels, backend, sampleSize=None,
+                 rng=None):
+    """
+    Returns the mean quadratic loss of the network over data
+    and labels, or over a random subsample of sampleSize
+    points if given. The subsample is drawn from rng, a
+    np.random.RandomState, or from a fresh one if not given,
+    so the global random state used in training is untouched.
+    """
+    if sampleSize is not None and sampleSize < labels.shape[0]:
+        if rng is None:
+            rng = np.random.RandomState()
+        sample = rng.choice(labels.shape[0], sampleSize, replace=False)
+        data = data[sample]
+        labels = labels[sample]
+    preds = batchForwardPass(params, bias, data, backend)
+    return cost(labels, preds) / labels.shape[0]
+
+
+def runTraining(data, labels, backend, optimizer, evalEvery=None,
+                evalSampleSize=None, callback=None, pool=None):
+    """
+    Runs the training loop of trainNetwork, passing pool on
+    to the optimizer.
     """
     np.random.seed(1)
+    evalRng = np.random.RandomState(1)
     numSamples = labels.shape[0]
     numTrain = int(numSamples * 0.75)
     ordering = np.random.permutation(range(numSamples))
@@ -263,19 +834,17 @@ def trainNetwork(data, labels, backend):
     batchSize = 5
     momentum = 0.9
     learningRate = 0.02
+    runningLoss = 0
 
     for iteration in range(15):
         samplePos = iteration * batchSize
         batchTrainingData = trainingData[samplePos:samplePos + batchSize]
         batchLabels = trainingLabels[samplePos:samplePos + batchSize]
-        batchGrads = np.zeros_like(params)
-        batchBiasGrad = 0
-        for i in range(batchSize):
-            grads, biasGrad = computeGradient(
-                params, batchTrainingData[i], batchLabels[i], bias, backend
-            )
-            batchGrads += grads / batchSize
-            batchBiasGrad += biasGrad / batchSize
+        batchGrads, batchBiasGrad, batchPreds = optimizer(
+            params, batchTrainingData, batchLabels, bias, backend, pool
+        )
+        batchLoss = cost(batchLabels, batchPreds) / batchLabels.shape[0]
+        runningLoss += (batchLoss - runningLoss) / (iteration + 1)
 
         params, prevParams = updateParams(
             params, prevParams, batchGrads, learningRate, momentum
@@ -285,17 +854,26 @@ def trainNetwork(data, labels, backend):
         bias += -learningRate * batchBiasGrad + momentum * (bias - prevBias)
         prevBias = temp
 
-        trainingPreds = np.array([forwardPass(
-            params, bias, angles, backend
-        ) for angles in trainingData])
-        print('Iteration {} | Loss: {}'.format(
-            iteration + 1, cost(trainingLabels, trainingPreds)
-        ))
-
-    validationProbs = np.array(
-        [forwardPass(
-            params, bias, angles, backend
-        ) for angles in validationData]
+        metrics = {
+            'iteration': iteration + 1,
+            'batchLoss': batchLoss,
+            'runningLoss': runningLoss
+        }
+        message = 'Iteration {} | Running loss: {}'.format(
+            iteration + 1, runningLoss
+        )
+        if evalEvery and (iteration + 1) % evalEvery == 0:
+            metrics['loss'] = evaluateLoss(
+                params, bias, trainingData, trainingLabels, backend,
+                evalSampleSize, evalRng
+            )
+            message += ' | Loss: {}'.format(metrics['loss'])
+        print(message)
+        if callback is not None:
+            callback(metrics, params, bias)
+
+    validationProbs = batchForwardPass(
+        params, bias, validationData, backend
     )
     validationClasses = convertToClass(validationProbs)
     validationAcc = accuracy(validationLabels, validationClasses)
@@ -303,10 +881,13 @@ def trainNetwork(data, labels, backend):
     for x, y, p in zip(validationData, validationLabels, validationClasses):
         print('Data:', x, ' | Class:', y, ' | Prediction:', p)
 
+    return params, bias
+
 
-data = np.genfromtxt("processedIRISData.csv", delimiter=",")
-X = data[:, 0:4]
-features = np.array([convertDataToAngles(i) for i in X])
-Y = data[:, -1]
-backend = Aer.get_backend('qasm_simulator')
-trainNetwork(features, Y, backend)
+if __name__ == '__main__':
+    data = np.genfromtxt("processedIRISData.csv", delimiter=",")
+    X = data[:, 0:4]
+    features = np.array([convertDataToAngles(i) for i in X])
+    Y = data[:, -1]
+    backend = Aer.get_backend('qasm_simulator')
+    trainNetwork(features, Y, backend)
@@ -0,0 +1,41 @@
+"""
+benchresults.py: writes the results of the benchmarks in this repository,
+a list of dictionaries with one entry per measurement, to CSV or JSON.
+"""
+
+import csv
+import json
+import platform
+import time
+
+import numpy as np
+
+
+def writeResults(results, path, restval=''):
+    """
+    Writes the benchmark results to path, as CSV if the file name ends
+    in .csv and as JSON otherwise. CSV columns are the union of the keys
+    of all the results, and keys missing from a result are written as
+    restval. JSON output also records the versions of the packages used.
+    """
+    if path.endswith('.csv'):
+        fieldnames = []
+        for row in results:
+            fieldnames += [key for key in row if key not in fieldnames]
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames,
+                                    restval=restval)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        import qiskit
+        metadata = {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'qiskit': dict(qiskit.__qiskit_version__),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        with open(path, 'w') as f:
+            json.dump({'metadata': metadata, 'results': results}, f,
+                      indent=4)
@@ -1,118 +1,482 @@
+from functools import lru_cache
+import os
+import sys
 import matplotlib.pyplot as plt
 import pandas as pd
 from qiskit import QuantumRegister, ClassicalRegister
 from qiskit import QuantumCircuit
-from qiskit import Aer, execute
+from qiskit import Aer
+from qiskit.circuit import Parameter
+from qiskit.circuit.library.standard_gates import RYGate
 from numpy import pi
+import numpy as np
 
-fig, ax = plt.subplots()
-ax.set(xlabel='Data Feature 1', ylabel='Data Feature 2')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qexecute import cachedExecute, executeTemplate
 
-# Get the data from the .csv file
-data = pd.read_csv('kmeans_data.csv',
-    usecols=['Feature 1', 'Feature 2', 'Class'])
+# Passing this in place of a backend selects the closed-form swap test
+EXACT = 'exact'
 
-# Create binary variables to filter data
-isGreen = data['Class'] == 'Green'
-isBlue = data['Class'] == 'Blue'
-isBlack = data['Class'] == 'Black'
 
-# Filter data
-greenData = data[isGreen].drop(['Class'], axis=1)
-blueData = data[isBlue].drop(['Class'], axis=1)
-blackData = data[isBlack].drop(['Class'], axis=1)
+def pointsToAngles(points):
+    """
+    Maps an array of 2D points with features in [-1, 1] to the angles
+    (theta, phi) used to encode them with u3(theta, phi, 0). The first
+    feature sets phi and the second sets theta.
+    """
+    points = np.asarray(points, dtype=float)
+    phi = (points[:, 0] + 1) * pi / 2
+    theta = (points[:, 1] + 1) * pi / 2
+    return theta, phi
 
-# This is the point we need to classify
-y_p = 0.141
-x_p = -0.161
 
-# Finding the x-coords of the centroids
-xgc = sum(greenData['Feature 1']) / len(greenData['Feature 1'])
-xbc = sum(blueData['Feature 1']) / len(blueData['Feature 1'])
-xkc = sum(blackData['Feature 1']) / len(blackData['Feature 1'])
+def swapTestCircuit(theta1, phi1, theta2, phi2):
+    """
+    Builds a swap test between the single qubit states encoded by the
+    angles (theta1, phi1) and (theta2, phi2). The probability of
+    measuring 1 is (1 - |<a|b>|^2) / 2, which grows with the distance
+    between the two points.
+    """
+    qreg = QuantumRegister(3, 'qreg')
+    creg = ClassicalRegister(1, 'creg')
+    qc = QuantumCircuit(qreg, creg, name='qc')
+    qc.h(qreg[2])
+    qc.u3(theta1, phi1, 0, qreg[0])
+    qc.u3(theta2, phi2, 0, qreg[1])
+    qc.cswap(qreg[2], qreg[0], qreg[1])
+    qc.h(qreg[2])
+    qc.measure(qreg[2], creg[0])
+    return qc
 
-# Finding the y-coords of the centroids
-ygc = sum(greenData['Feature 2']) / len(greenData['Feature 2'])
-ybc = sum(blueData['Feature 2']) / len(blueData['Feature 2'])
-ykc = sum(blackData['Feature 2']) / len(blackData['Feature 2'])
 
-# Plotting the centroids
-plt.plot(xgc, ygc, 'gx')
-plt.plot(xbc, ybc, 'bx')
-plt.plot(xkc, ykc, 'kx')
+def estimateDistances(points, centroids, backend, shots=1024):
+    """
+    Estimates the distance between each of the N points and each of the
+    K centroids by running all N * K swap tests as a single job. Returns
+    an (N, K) array holding the fraction of shots in which each swap test
+    measured 1.
+    """
+    theta_points, phi_points = pointsToAngles(points)
+    theta_centroids, phi_centroids = pointsToAngles(centroids)
+    return estimateAngleDistances(theta_points, phi_points,
+                                  theta_centroids, phi_centroids,
+                                  backend, shots)
 
-# Plotting the new data point
-plt.plot(x_p, y_p, 'ro')
 
-# Setting the axis ranges
-plt.axis([-1, 1, -1, 1])
+@lru_cache(maxsize=None)
+def buildSwapTestTemplate():
+    """
+    Builds the swap test circuit once, with the encoding angles of both
+    states left as unbound Parameters. Returns the circuit along with
+    the Parameters (theta1, phi1, theta2, phi2).
+    """
+    params = tuple(Parameter(name) for name in
+                   ['theta1', 'phi1', 'theta2', 'phi2'])
+    return swapTestCircuit(*params), params
 
-plt.show()
 
-# Calculating theta and phi values
-phi_list = [((x + 1) * pi / 2) for x in [x_p, xgc, xbc, xkc]]
-theta_list = [((x + 1) * pi / 2) for x in [y_p, ygc, ybc, ykc]]
+def exactAngleDistances(theta_points, phi_points, theta_centroids,
+                        phi_centroids):
+    """
+    Returns the exact probability of each swap test measuring 1,
+    (1 - |<a|b>|^2) / 2, for every (point, centroid) pair at once. The
+    state u3(theta, phi, 0)|0> is cos(theta/2)|0> + e^(i phi) sin(theta/2)|1>,
+    so the overlaps follow directly from the angles.
+    """
+    theta_points = np.asarray(theta_points)[:, None]
+    phi_points = np.asarray(phi_points)[:, None]
+    theta_centroids = np.asarray(theta_centroids)[None, :]
+    phi_centroids = np.asarray(phi_centroids)[None, :]
+    overlaps = np.cos(theta_points / 2) * np.cos(theta_centroids / 2) + \
+        np.exp(1j * (phi_centroids - phi_points)) * \
+        np.sin(theta_points / 2) * np.sin(theta_centroids / 2)
+    return (1 - np.abs(overlaps) ** 2) / 2
 
-# Create a 2 qubit QuantumRegister - two for the vectors, and 
-# one for the ancillary qubit
-qreg = QuantumRegister(3, 'qreg')
 
-# Create a one bit ClassicalRegister to hold the result
-# of the measurements
-creg = ClassicalRegister(1, 'creg')
+def estimateAngleDistances(theta_points, phi_points, theta_centroids,
+                           phi_centroids, backend, shots=1024):
+    """
+    Same as estimateDistances, but takes the encoding angles of the
+    points and centroids instead, so they can be computed once and
+    reused. Every (point, centroid) pair is an independent binding of
+    the same swap test template, so the cost is linear in the number
+    of centroids. With the exact backend, the probabilities are
+    computed in closed form instead.
+    """
+    if backend == EXACT:
+        return exactAngleDistances(theta_points, phi_points,
+                                   theta_centroids, phi_centroids)
 
-qc = QuantumCircuit(qreg, creg, name='qc')
+    template, params = buildSwapTestTemplate()
+    bindings = []
 
-# Get backend using the Aer provider
-backend = Aer.get_backend('qasm_simulator')
+    for i in range(len(theta_points)):
+        for j in range(len(theta_centroids)):
+            bindings.append(dict(zip(params, (
+                theta_points[i], phi_points[i],
+                theta_centroids[j], phi_centroids[j]
+            ))))
 
-# Create list to hold the results
-results_list = []
+    result = executeTemplate(template, bindings, backend,
+                             shots=shots).result()
+    counts = [result.get_counts(k).get('1', 0) for k in range(len(bindings))]
+    return np.array(counts).reshape(len(theta_points), -1) / shots
 
-# Estimating distances from the new point to the centroids
-for i in range(1, 4):
-    # Apply a Hadamard to the ancillary
-    qc.h(qreg[2])
 
-    # Encode new point and centroid
-    qc.u3(theta_list[0], phi_list[0], 0, qreg[0])           
-    qc.u3(theta_list[i], phi_list[i], 0, qreg[1]) 
+def classifyPoints(points, centroids, backend, shots=1024):
+    """
+    Assigns each point to the centroid with the smallest estimated
+    distance. Returns the (N, K) distance estimates along with the index
+    of the closest centroid for every point.
+    """
+    distances = estimateDistances(points, centroids, backend, shots)
+    return distances, np.argmin(distances, axis=1)
 
-    # Perform controlled swap
-    qc.cswap(qreg[2], qreg[0], qreg[1])
-    # Apply second Hadamard to ancillary
-    qc.h(qreg[2])
 
-    # Measure ancillary
-    qc.measure(qreg[2], creg[0])
+def updateCentroids(points, labels, centroids):
+    """
+    Returns the mean of the points assigned to each centroid. Centroids
+    that have no points assigned to them are left where they are.
+    """
+    num_clusters = centroids.shape[0]
+    counts = np.bincount(labels, minlength=num_clusters)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, labels, points)
+    return np.where(counts[:, None] > 0,
+                    sums / np.maximum(counts, 1)[:, None], centroids)
+
+
+def quantumKMeans(points, numClusters, backend, maxIterations=20,
+                  tolerance=1e-4, shots=1024, seed=None):
+    """
+    Clusters points into numClusters clusters using Lloyd's algorithm,
+    with the distances between points and centroids estimated by swap
+    tests. The centroids start at randomly chosen points, and the loop
+    stops once the assignments stop changing, the centroids move by less
+    than tolerance, or maxIterations is reached. The encoding angles of
+    the points are computed only once.
+
+    Returns the centroids, the cluster index of every point and the
+    number of iterations run.
+    """
+    points = np.asarray(points, dtype=float)
+    rng = np.random.RandomState(seed)
+    centroids = points[rng.choice(points.shape[0], numClusters,
+                                  replace=False)]
+    theta_points, phi_points = pointsToAngles(points)
+    labels = None
+
+    for iteration in range(maxIterations):
+        theta_centroids, phi_centroids = pointsToAngles(centroids)
+        distances = estimateAngleDistances(theta_points, phi_points,
+                                           theta_centroids, phi_centroids,
+                                           backend, shots)
+        new_labels = np.argmin(distances, axis=1)
+        new_centroids = updateCentroids(points, new_labels, centroids)
+        shift = np.max(np.linalg.norm(new_centroids - centroids, axis=1))
+        centroids = new_centroids
+        converged = labels is not None and \
+            np.array_equal(new_labels, labels)
+        labels = new_labels
+
+        if converged or shift < tolerance:
+            break
+
+    return centroids, labels, iteration + 1
+
+
+def wilsonInterval(ones, shots, z):
+    """
+    Returns the lower and upper ends of the Wilson score interval for a
+    probability estimated from ones successes out of shots trials.
+    """
+    p = ones / shots
+    denominator = 1 + z ** 2 / shots
+    centre = (p + z ** 2 / (2 * shots)) / denominator
+    half_width = z / denominator * np.sqrt(
+        p * (1 - p) / shots + z ** 2 / (4 * shots ** 2)
+    )
+    return centre - half_width, centre + half_width
+
+
+def sequentialAssign(points, centroids, backend, shotStep=64, maxShots=1024,
+                     z=2.576, seed=None):
+    """
+    Assigns each point to its closest centroid, running the swap tests
+    in increments of shotStep shots instead of a fixed number. A point
+    stops being sampled as soon as the confidence interval (Wilson, with
+    z standard deviations) of its closest centroid lies entirely below
+    the intervals of all the other centroids, or after maxShots shots.
+    Every round submits the swap tests of all the points still being
+    sampled as a single job. With the exact backend, shots are drawn
+    from the closed-form probabilities.
+
+    Returns the cluster index of every point, the (N, K) distance
+    estimates and the number of shots spent on each swap test of every
+    point.
+    """
+    rng = np.random.RandomState(seed)
+    theta_points, phi_points = pointsToAngles(points)
+    theta_centroids, phi_centroids = pointsToAngles(centroids)
+    num_points = len(theta_points)
+    ones = np.zeros((num_points, len(theta_centroids)))
+    shots = np.zeros(num_points, dtype=int)
+    labels = np.zeros(num_points, dtype=int)
+    active = np.arange(num_points)
+
+    while active.size:
+        if backend == EXACT:
+            new_ones = rng.binomial(shotStep, exactAngleDistances(
+                theta_points[active], phi_points[active],
+                theta_centroids, phi_centroids
+            ))
+        else:
+            new_ones = np.round(shotStep * estimateAngleDistances(
+                theta_points[active], phi_points[active],
+                theta_centroids, phi_centroids, backend, shotStep
+            ))
+        ones[active] += new_ones
+        shots[active] += shotStep
+
+        lower, upper = wilsonInterval(ones[active],
+                                      shots[active][:, None], z)
+        closest = np.argmin(ones[active], axis=1)
+        rows = np.arange(active.size)
+        others_lower = np.where(
+            np.arange(ones.shape[1]) == closest[:, None], np.inf, lower
+        )
+        separated = upper[rows, closest] < np.min(others_lower, axis=1)
+        finished = separated | (shots[active] >= maxShots)
+        labels[active[finished]] = closest[finished]
+        active = active[~finished]
+
+    return labels, ones / shots[:, None], shots
+
+
+def padVectors(vectors):
+    """
+    Zero pads an (N, d) array of feature vectors to a power of two
+    length and normalises every row. Rows that are all zero are left
+    as they are.
+    """
+    vectors = np.asarray(vectors, dtype=float)
+    num_qubits = max(1, int(np.ceil(np.log2(vectors.shape[1]))))
+    padded = np.zeros((vectors.shape[0], 2 ** num_qubits))
+    padded[:, :vectors.shape[1]] = vectors
+    norms = np.linalg.norm(padded, axis=1, keepdims=True)
+    return padded / np.where(norms > 0, norms, 1)
+
+
+def amplitudeEncodingAngles(vectors):
+    """
+    Computes, for the whole dataset at once, the RY angles that
+    amplitude encode each real feature vector into ceil(log2(d)) qubits.
+    Returns the number of qubits and an (N, 2^n - 1) array of angles,
+    stored level by level: level l has 2^l angles, one for every value
+    of the l qubits already prepared.
+    """
+    padded = padVectors(vectors)
+    num_qubits = int(np.log2(padded.shape[1]))
+    angles = []
+
+    for level in range(num_qubits):
+        halves = padded.reshape(padded.shape[0], 2 ** level, 2, -1)
+        if level < num_qubits - 1:
+            norms = np.linalg.norm(halves, axis=3)
+            angles.append(2 * np.arctan2(norms[:, :, 1], norms[:, :, 0]))
+        else:
+            # The last level also carries the signs of the amplitudes
+            angles.append(2 * np.arctan2(halves[:, :, 1, 0],
+                                         halves[:, :, 0, 0]))
+
+    return num_qubits, np.concatenate(angles, axis=1)
+
+
+def amplitudeEncode(qc, qreg, angles):
+    """
+    Prepares the amplitude encoded state described by angles, as
+    returned by amplitudeEncodingAngles, on register qreg. Level l
+    rotates qubit n - 1 - l with an RY conditioned on the value of the
+    qubits above it, so amplitude i ends up on basis state |i>.
+    """
+    num_qubits = len(qreg)
+
+    for level in range(num_qubits):
+        target = qreg[num_qubits - 1 - level]
+        controls = [qreg[num_qubits - 1 - k] for k in range(level)]
+
+        for j in range(2 ** level):
+            angle = angles[2 ** level - 1 + j]
+            if not level:
+                qc.ry(angle, target)
+                continue
+
+            flips = [controls[k] for k in range(level)
+                     if not (j >> (level - 1 - k)) & 1]
+            for qubit in flips:
+                qc.x(qubit)
+            qc.append(RYGate(angle).control(level), controls + [target])
+            for qubit in flips:
+                qc.x(qubit)
+
+
+@lru_cache(maxsize=None)
+def buildAmplitudeSwapTestTemplate(numQubits):
+    """
+    Builds the swap test between two amplitude encoded states on
+    numQubits qubits each, once per number of qubits, with the 2^n - 1
+    RY angles of both encodings left as unbound Parameters. Returns the
+    circuit along with the point and centroid Parameters, in the order
+    used by amplitudeEncodingAngles.
+    """
+    num_angles = 2 ** numQubits - 1
+    point_params = [Parameter('a{}'.format(k)) for k in range(num_angles)]
+    centroid_params = [Parameter('b{}'.format(k)) for k in range(num_angles)]
+
+    a = QuantumRegister(numQubits, 'a')
+    b = QuantumRegister(numQubits, 'b')
+    anc = QuantumRegister(1, 'anc')
+    creg = ClassicalRegister(1, 'creg')
+    qc = QuantumCircuit(a, b, anc, creg)
+    qc.h(anc[0])
+    amplitudeEncode(qc, a, point_params)
+    amplitudeEncode(qc, b, centroid_params)
+    for k in range(numQubits):
+        qc.cswap(anc[0], a[k], b[k])
+    qc.h(anc[0])
+    qc.measure(anc[0], creg[0])
+    return qc, point_params, centroid_params
+
+
+def estimateAmplitudeDistances(points, centroids, backend, shots=1024):
+    """
+    Estimates the distance between each of the N d-dimensional points
+    and each of the K centroids with a swap test between their amplitude
+    encodings, using 2 * ceil(log2(d)) + 1 qubits. Returns an (N, K)
+    array of the probabilities of measuring 1, (1 - <a|b>^2) / 2, where
+    a and b are the normalised vectors. Every (point, centroid) pair is
+    a binding of the same swap test template, and all N * K swap tests
+    are submitted as a single job; with the exact backend, the
+    probabilities are computed directly from the vectors instead.
+    """
+    if backend == EXACT:
+        overlaps = padVectors(points) @ padVectors(centroids).T
+        return (1 - overlaps ** 2) / 2
+
+    num_qubits, point_angles = amplitudeEncodingAngles(points)
+    _, centroid_angles = amplitudeEncodingAngles(centroids)
+    template, point_params, centroid_params = \
+        buildAmplitudeSwapTestTemplate(num_qubits)
+    bindings = []
+
+    for angles in point_angles:
+        for centroid in centroid_angles:
+            binding = dict(zip(point_params, angles))
+            binding.update(zip(centroid_params, centroid))
+            bindings.append(binding)
+
+    result = executeTemplate(template, bindings, backend,
+                             shots=shots).result()
+    counts = [result.get_counts(k).get('1', 0) for k in range(len(bindings))]
+    return np.array(counts).reshape(len(point_angles), -1) / shots
+
+
+def compareToExact(points, centroids, backend, shots=1024,
+                   estimator=estimateAmplitudeDistances):
+    """
+    Checks a shot-based distance estimator against its exact mode. Runs
+    estimator on backend and with EXACT, and returns the largest absolute
+    difference between the two, along with the largest difference in units
+    of the binomial standard deviation of an estimate from shots shots.
+    Differences of more than a few standard deviations mean the circuits
+    do not compute the distances they should.
+    """
+    estimated = estimator(points, centroids, backend, shots=shots)
+    exact = estimator(points, centroids, EXACT)
+    std = np.sqrt(np.maximum(exact * (1 - exact), 1 / shots) / shots)
+
+    return {
+        'maxAbsError': np.max(np.abs(estimated - exact)),
+        'maxZScore': np.max(np.abs(estimated - exact) / std)
+    }
+
+
+if __name__ == '__main__':
+    fig, ax = plt.subplots()
+    ax.set(xlabel='Data Feature 1', ylabel='Data Feature 2')
+
+    # Get the data from the .csv file
+    data = pd.read_csv('kmeans_data.csv',
+        usecols=['Feature 1', 'Feature 2', 'Class'])
+
+    # Create binary variables to filter data
+    isGreen = data['Class'] == 'Green'
+    isBlue = data['Class'] == 'Blue'
+    isBlack = data['Class'] == 'Black'
+
+    # Filter data
+    greenData = data[isGreen].drop(['Class'], axis=1)
+    blueData = data[isBlue].drop(['Class'], axis=1)
+    blackData = data[isBlack].drop(['Class'], axis=1)
+
+    # This is the point we need to classify
+    y_p = 0.141
+    x_p = -0.161
+
+    # Finding the x-coords of the centroids
+    xgc = sum(greenData['Feature 1']) / len(greenData['Feature 1'])
+    xbc = sum(blueData['Feature 1']) / len(blueData['Feature 1'])
+    xkc = sum(blackData['Feature 1']) / len(blackData['Feature 1'])
+
+    # Finding the y-coords of the centroids
+    ygc = sum(greenData['Feature 2']) / len(greenData['Feature 2'])
+    ybc = sum(blueData['Feature 2']) / len(blueData['Feature 2'])
+    ykc = sum(blackData['Feature 2']) / len(blackData['Feature 2'])
+
+    # Plotting the centroids
+    plt.plot(xgc, ygc, 'gx')
+    plt.plot(xbc, ybc, 'bx')
+    plt.plot(xkc, ykc, 'kx')
+
+    # Plotting the new data point
+    plt.plot(x_p, y_p, 'ro')
+
+    # Setting the axis ranges
+    plt.axis([-1, 1, -1, 1])
+
+    plt.show()
+
+    # Get backend using the Aer provider
+    backend = Aer.get_backend('qasm_simulator')
 
-    # Reset qubits
-    qc.reset(qreg)
+    # Estimating distances from the new point to the centroids, with one
+    # independent swap test per centroid, all submitted as a single job
+    distances = estimateDistances([[x_p, y_p]],
+                                  [[xgc, ygc], [xbc, ybc], [xkc, ykc]],
+                                  backend, shots=1024)
 
-    # Register and execute job
-    job = execute(qc, backend=backend, shots=1024)
-    result = job.result().get_counts(qc)
-    results_list.append(result['1'])
+    # Number of shots in which each swap test measured 1
+    results_list = [int(round(d * 1024)) for d in distances[0]]
 
-print(results_list)
+    print(results_list)
 
-# Create a list to hold the possible classes
-class_list = ['Green', 'Blue', 'Black']
+    # Create a list to hold the possible classes
+    class_list = ['Green', 'Blue', 'Black']
 
-# Find out which class the new data point belongs to 
-# according to our distance estimation algorithm
-quantum_p_class = class_list[results_list.index(min(results_list))]
+    # Find out which class the new data point belongs to 
+    # according to our distance estimation algorithm
+    quantum_p_class = class_list[results_list.index(min(results_list))]
 
-# Find out which class the new data point belongs to 
-# according to classical euclidean distance calculation
-distances_list = [((x_p - i[0])**2 + (y_p - i[1])**2)**0.5 for i in [(xgc, ygc), (xbc, ybc), (xkc, ykc)]]
-classical_p_class = class_list[distances_list.index(min(distances_list))]
+    # Find out which class the new data point belongs to 
+    # according to classical euclidean distance calculation
+    distances_list = [((x_p - i[0])**2 + (y_p - i[1])**2)**0.5 for i in [(xgc, ygc), (xbc, ybc), (xkc, ykc)]]
+    classical_p_class = class_list[distances_list.index(min(distances_list))]
 
-# Print results
-print("""According to our distance algorithm,
+    # Print results
+    print("""According to our distance algorithm,
  the new data point belongs to the""", quantum_p_class, 
- 'class.\n')
-print('Euclidean distances: ', distances_list, '\n')
-print("""According to euclidean distance calculations,
+     'class.\n')
+    print('Euclidean distances: ', distances_list, '\n')
+    print("""According to euclidean distance calculations,
  the new data point belongs to the""", classical_p_class, 
- 'class.')
\ No newline at end of file
+     'class.')
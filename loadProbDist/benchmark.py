@@ -0,0 +1,138 @@
+"""
+benchmark.py: compares the circuits built by encodeDist with and without
+Gray code ordering of the regions, and measures how the time and resources
+needed by the encoders scale with the number of qubits, writing the
+results to a CSV file.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from qiskit import transpile
+import numpy as np
+
+from loadProbDist import distribution, computeRegionMasses, encodeMasses
+from loadProbDist import encodeMassesMultiplexed, exactRegionProbabilities
+from loadProbDist import compareToMasses
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchresults import writeResults
+
+
+def compareFlipOrdering(qubitCounts):
+    """
+    Builds the encoder for N(0, 2) over [-16, 16] for every number of
+    qubits in qubitCounts, in the default and the Gray code region order.
+    Returns a list of dictionaries holding the number of X gates, the total
+    gate count and the depth of each circuit, both as built and after
+    decomposing into u3 and cx gates without optimisation.
+    """
+    results = []
+
+    for numQubits in qubitCounts:
+        regBounds = np.linspace(-16, 16, 2 ** numQubits + 1)
+        masses = computeRegionMasses(distribution, regBounds)
+
+        for grayOrder in [False, True]:
+            qc, a, c = encodeMasses(masses, grayOrder)
+            decomposed = transpile(qc, basis_gates=['u3', 'cx'],
+                                   optimization_level=0)
+            results.append({
+                'numQubits': numQubits,
+                'grayOrder': grayOrder,
+                'xGates': qc.count_ops().get('x', 0),
+                'gates': sum(qc.count_ops().values()),
+                'depth': qc.depth(),
+                'decomposedGates': sum(decomposed.count_ops().values()),
+                'decomposedDepth': decomposed.depth()
+            })
+
+    return results
+
+
+def measureScaling(qubitCounts, encoders=('ancilla', 'multiplexed'),
+                   simulate=True):
+    """
+    Encodes N(0, 2) over [-16, 16] for every number of qubits in
+    qubitCounts with each of the given encoders, where 'ancilla' is
+    encodeDist and 'multiplexed' is encodeDistMultiplexed. Returns a list
+    of dictionaries holding the time spent integrating the regions with
+    quad, the circuit construction and transpilation times, the qubit
+    count, the gate count of every gate type, the depth after transpiling
+    into u3 and cx gates, and, if simulate is True, the time taken to
+    compute the exact statevector and its largest error in any region.
+    """
+    builders = {'ancilla': encodeMasses,
+                'multiplexed': encodeMassesMultiplexed}
+    results = []
+
+    for numQubits in qubitCounts:
+        regBounds = np.linspace(-16, 16, 2 ** numQubits + 1)
+
+        start = time.perf_counter()
+        masses = computeRegionMasses(distribution, regBounds)
+        quadTime = time.perf_counter() - start
+
+        for encoder in encoders:
+            start = time.perf_counter()
+            qc, a, c = builders[encoder](masses)
+            constructionTime = time.perf_counter() - start
+
+            start = time.perf_counter()
+            transpiled = transpile(qc, basis_gates=['u3', 'cx'],
+                                   optimization_level=1)
+            transpileTime = time.perf_counter() - start
+
+            row = {
+                'numQubits': numQubits,
+                'encoder': encoder,
+                'quadTime': quadTime,
+                'constructionTime': constructionTime,
+                'transpileTime': transpileTime,
+                'circuitQubits': qc.num_qubits,
+                'depth': qc.depth(),
+                'transpiledDepth': transpiled.depth(),
+                'transpiledGates': sum(transpiled.count_ops().values())
+            }
+
+            for name, count in qc.count_ops().items():
+                row['gates_' + name] = count
+
+            if simulate:
+                start = time.perf_counter()
+                probs = exactRegionProbabilities(qc, a, numQubits)
+                row['simulationTime'] = time.perf_counter() - start
+                row['maxAbsError'] = compareToMasses(
+                    probs, masses)['maxAbsError']
+
+            print(row)
+            results.append(row)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the encoders in loadProbDist.py.')
+    parser.add_argument('--report', choices=['ordering', 'scaling'],
+                        default='scaling')
+    parser.add_argument('--qubits', type=int, nargs='+')
+    parser.add_argument('--encoders', nargs='+',
+                        choices=['ancilla', 'multiplexed'],
+                        default=['ancilla', 'multiplexed'])
+    parser.add_argument('--no-simulate', action='store_true',
+                        help='skip the statevector simulation')
+    parser.add_argument('--output', default='scaling_results.csv')
+    args = parser.parse_args()
+
+    if args.report == 'ordering':
+        results = compareFlipOrdering(args.qubits or range(2, 9))
+        print(' | '.join(results[0].keys()))
+        for row in results:
+            print(' | '.join(str(value) for value in row.values()))
+    else:
+        results = measureScaling(args.qubits or range(2, 13), args.encoders,
+                                 not args.no_simulate)
+        writeResults(results, args.output, restval=0)
@@ -4,13 +4,21 @@ intervals, discretizes the distribution over the given intervals and
 encodes it as a quantum superposition state.
 """
 
+import os
+import sys
+from itertools import islice
 from qiskit import QuantumRegister, ClassicalRegister
-from qiskit import Aer, execute, QuantumCircuit
+from qiskit import Aer, QuantumCircuit
 from qiskit.circuit.library.standard_gates import RYGate
+from qiskit.quantum_info import Statevector
 from numpy import pi, e, sqrt, arccos, log2
 from scipy.integrate import quad
+import numpy as np
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qexecute import cachedExecute
+
 # Take the distribution given by N(0, 2) discretized into 16 parts labelled 0-15
 # covering [, -7], [-7, -6], [-6, -5], [-5, -4], ...., [7,]
 
@@ -60,6 +68,78 @@ def computeRegionProbability(dist, regBounds, numRegions, j):
     return prob
 
 
+def computeRegionMasses(dist, regBounds):
+    """
+    Returns the probability mass of dist in each of the elementary regions
+    given by regBounds. If dist has a cdf method, like the frozen
+    distributions in scipy.stats, the masses are differences of the CDF at
+    the region boundaries; otherwise every region is integrated exactly once.
+    """
+    regBounds = np.asarray(regBounds, dtype=float)
+
+    if hasattr(dist, 'cdf'):
+        return np.diff(dist.cdf(regBounds))
+
+    return np.array([integrate(dist, regBounds[i], regBounds[i + 1])
+        for i in range(len(regBounds) - 1)])
+
+
+def computeConditionalProbabilities(masses):
+    """
+    Given the masses of 2^n elementary regions, returns a list holding, for
+    every level of discretization i, the array of probabilities that the
+    random variable lies in the left half of each of the 2^i regions at
+    that level, given that it lies in that region. These are the same
+    values computeRegionProbability returns, but all the levels are built
+    from the masses in one vectorized pass, by summing adjacent pairs of
+    regions to get the next coarser level. Unlike differences of a running
+    CDF, this keeps full relative precision in the tails.
+    """
+    blocks = np.asarray(masses, dtype=float)
+    probs = []
+
+    while len(blocks) > 1:
+        left = blocks[0::2]
+        total = left + blocks[1::2]
+        probs.append(np.where(total > 0, left / np.where(total > 0, total, 1),
+            1))
+        blocks = total
+
+    return probs[::-1]
+
+
+def walshHadamardTransform(values):
+    """
+    Returns the (unnormalised) Walsh-Hadamard transform of an array whose
+    length is a power of 2, computed with log2(len(values)) vectorized
+    butterfly steps.
+    """
+    values = np.array(values, dtype=float)
+    h = 1
+
+    while h < len(values):
+        pairs = values.reshape(-1, 2, h)
+        values = np.concatenate([pairs[:, 0] + pairs[:, 1],
+            pairs[:, 0] - pairs[:, 1]], axis=1).reshape(-1)
+        h *= 2
+
+    return values
+
+
+def computeMultiplexorAngles(thetas):
+    """
+    Given the 2^k angles of a uniformly controlled RY gate, one for every
+    state of its k control qubits, returns the 2^k angles of the single
+    qubit RY gates in its CNOT + RY ladder decomposition. Step l of the
+    ladder leaves RY(phi_l) acting with sign (-1)^(j . g_l) for control
+    state j, where g_l is the l-th Gray code, so phi is the Walsh-Hadamard
+    transform of thetas divided by 2^k and permuted into Gray code order.
+    """
+    numAngles = len(thetas)
+    grayCodes = np.arange(numAngles) ^ (np.arange(numAngles) >> 1)
+    return walshHadamardTransform(thetas)[grayCodes] / numAngles
+
+
 def getFlipList(i, j, numQubits):
     """
     Given the current level of desired level of discretization, the
@@ -88,7 +168,7 @@ def pad(x, numQubits):
     return string
 
 
-def encodeDist(dist, regBounds):
+def encodeDist(dist, regBounds, grayOrder=False):
     """
     Discretize the distribution dist into multiple regions with boundaries
     given by regBounds, and store the associated quantum superposition
@@ -100,11 +180,25 @@ def encodeDist(dist, regBounds):
     being used - this is due to the requirement of (n - 2) ancilla qubits in
     order to perform (n - 1) control operations with minimal possible depth.
 
+    If grayOrder is True, the regions at each level are visited in Gray code
+    order, so consecutive regions differ in a single control bit and only
+    that X flip is applied between them, instead of undoing and redoing all
+    the flips of every region.
+
     Returns a new quantum circuit containing the instructions and registers
     needed to create the superposition state, along with the size of the
     quantum register.
     """
-    numQubits = int(log2(len(regBounds) - 1))
+    return encodeMasses(computeRegionMasses(dist, regBounds), grayOrder)
+
+
+def encodeMasses(masses, grayOrder=False):
+    """
+    Same as encodeDist, but takes the probability masses of the 2^n regions
+    directly instead of a distribution and its region boundaries.
+    """
+    numQubits = int(log2(len(masses)))
+    conditionalProbs = computeConditionalProbabilities(masses)
 
     a = QuantumRegister(2 * numQubits - 2)
     c = ClassicalRegister(numQubits)
@@ -112,9 +206,13 @@ def encodeDist(dist, regBounds):
 
     for i in range(numQubits):
         numRegions = int(2 ** (i + 1))
+        flipped = []
 
-        for j in range(numRegions // 2):
-            prob = computeRegionProbability(dist, regBounds, numRegions, j)
+        for l in range(numRegions // 2):
+            # The controlled rotations of different regions act on disjoint
+            # control states, so they can be applied in any order
+            j = l ^ (l >> 1) if grayOrder else l
+            prob = conditionalProbs[i][j]
 
             if not i:
                 qc.ry(2 * arccos(sqrt(prob)), a[2 * numQubits - 3])
@@ -122,8 +220,13 @@ def encodeDist(dist, regBounds):
                 cGate = RYGate(2 * arccos(sqrt(prob))).control(i)
                 listOfFlips = getFlipList(i, j, numQubits)
 
-                for k in listOfFlips:
-                    qc.x(a[k])
+                if grayOrder:
+                    for k in sorted(set(flipped) ^ set(listOfFlips)):
+                        qc.x(a[k])
+                    flipped = listOfFlips
+                else:
+                    for k in listOfFlips:
+                        qc.x(a[k])
 
                 qubitsUsed = [a[k] for k in
                     range(2 * numQubits - 2 - i, 2 * numQubits - 2)]
@@ -131,38 +234,256 @@ def encodeDist(dist, regBounds):
                 qubitsUsed.append(a[2 * numQubits - 3 - i])
                 qc.append(cGate, qubitsUsed)
 
-                for k in listOfFlips:
-                    qc.x(a[k])
+                if not grayOrder:
+                    for k in listOfFlips:
+                        qc.x(a[k])
+
+        for k in flipped:
+            qc.x(a[k])
+
+    return qc, a, c
+
+
+def encodeDistMultiplexed(dist, regBounds):
+    """
+    Alternative to encodeDist that needs no ancilla qubits. Each level of
+    conditional rotations is applied as one uniformly controlled RY gate,
+    decomposed into a ladder of 2^i RY and CNOT gates, instead of 2^i
+    multi-controlled RY gates wrapped in X flips.
+
+    Returns a new quantum circuit acting on numQubits qubits, along with
+    its quantum and classical registers. Region j corresponds to measuring
+    the binary value of j, with qubit k of the register measured into bit
+    k of the classical register.
+    """
+    return encodeMassesMultiplexed(computeRegionMasses(dist, regBounds))
+
+
+def encodeMassesMultiplexed(masses):
+    """
+    Same as encodeDistMultiplexed, but takes the probability masses of the
+    2^n regions directly instead of a distribution and its region
+    boundaries.
+    """
+    numQubits = int(log2(len(masses)))
+    conditionalProbs = computeConditionalProbabilities(masses)
+
+    a = QuantumRegister(numQubits)
+    c = ClassicalRegister(numQubits)
+    qc = QuantumCircuit(a, c)
+
+    for i in range(numQubits):
+        target = a[numQubits - 1 - i]
+        thetas = 2 * arccos(sqrt(conditionalProbs[i]))
+
+        if not i:
+            qc.ry(thetas[0], target)
+            continue
+
+        phis = computeMultiplexorAngles(thetas)
+
+        for l in range(2 ** i):
+            qc.ry(phis[l], target)
+
+            # The control whose bit changes between Gray codes l and l + 1
+            if l == 2 ** i - 1:
+                bit = i - 1
+            else:
+                bit = ((l + 1) & -(l + 1)).bit_length() - 1
+
+            qc.cx(a[numQubits - i + bit], target)
 
     return qc, a, c
 
 
-regBounds = [i for i in range(-16, 17)]
-qc, a, c = encodeDist(distribution, regBounds)
-numQubits = (qc.num_qubits + 2) // 2
+def iterSampleChunks(path, chunkSize=100000, column=0, skiprows=0):
+    """
+    Yields the samples stored in path as arrays of at most chunkSize values,
+    so that the whole file is never held in memory. A .npy file is memory
+    mapped and sliced; any other file is read as CSV, a block of lines at a
+    time, taking the given column of every row after skipping the first
+    skiprows lines, such as a header.
+    """
+    if path.endswith('.npy'):
+        samples = np.load(path, mmap_mode='r')
+        if samples.ndim > 1:
+            samples = samples[:, column]
+
+        for start in range(0, len(samples), chunkSize):
+            yield np.asarray(samples[start:start + chunkSize], dtype=float)
+    else:
+        with open(path) as f:
+            for _ in islice(f, skiprows):
+                pass
+
+            while True:
+                lines = list(islice(f, chunkSize))
+                if not lines:
+                    break
+                yield np.loadtxt(lines, delimiter=',', usecols=column,
+                    ndmin=1)
+
+
+def streamHistogram(path, numQubits, lower=None, upper=None,
+        chunkSize=100000, column=0, skiprows=0):
+    """
+    Accumulates a histogram of the samples in path over 2^numQubits equal
+    bins covering [lower, upper], one chunk at a time. If either bound is
+    not given, an extra pass over the file finds the smallest or largest
+    sample. Samples outside [lower, upper] are not counted.
+
+    Returns the count in every bin along with the bin boundaries. Raises a
+    ValueError if the file holds no samples, or if lower is not below
+    upper, as happens when every sample has the same value and no bounds
+    are given.
+    """
+    if lower is None or upper is None:
+        lowest, highest = np.inf, -np.inf
+        for chunk in iterSampleChunks(path, chunkSize, column, skiprows):
+            if len(chunk):
+                lowest = min(lowest, np.min(chunk))
+                highest = max(highest, np.max(chunk))
+
+        if lowest > highest:
+            raise ValueError('%s holds no samples.' % path)
+
+        lower = lowest if lower is None else lower
+        upper = highest if upper is None else upper
+
+    if not lower < upper:
+        raise ValueError('The histogram range [%g, %g] of %s is empty; '
+            'pass lower and upper bounds with lower < upper.' %
+            (lower, upper, path))
+
+    regBounds = np.linspace(lower, upper, 2 ** numQubits + 1)
+    counts = np.zeros(2 ** numQubits, dtype=np.int64)
+    numSamples = 0
+
+    for chunk in iterSampleChunks(path, chunkSize, column, skiprows):
+        counts += np.histogram(chunk, bins=regBounds)[0]
+        numSamples += len(chunk)
+
+    if not numSamples:
+        raise ValueError('%s holds no samples.' % path)
 
-for i in range(numQubits - 2, 2 * numQubits - 2):
-    qc.measure(a[i], c[i - (numQubits - 2)])
+    return counts, regBounds
 
-backend = Aer.get_backend('qasm_simulator')
-shots = 100000
-job = execute(qc, backend=backend, shots=shots)
-results = job.result().get_counts()
-resultsX = []
-resultsY = []
 
-for i in [pad(bin(x), numQubits) for x in range(2 ** (numQubits))]:
-    resultsX.append(i)
-    if i in results.keys():
-        resultsY.append(results[i])
+def encodeSamples(path, numQubits, lower=None, upper=None, multiplexed=False,
+        chunkSize=100000, column=0, skiprows=0):
+    """
+    Encodes the empirical distribution of the samples stored in path, read
+    in chunks by streamHistogram, as a superposition over 2^numQubits
+    regions. The normalised bin counts are passed to encodeMassesMultiplexed
+    if multiplexed is True, and to encodeMasses otherwise.
+
+    Returns the quantum circuit, its quantum and classical registers, and
+    the region boundaries.
+    """
+    counts, regBounds = streamHistogram(path, numQubits, lower, upper,
+        chunkSize, column, skiprows)
+
+    if not np.sum(counts):
+        raise ValueError('No samples of %s lie in [%g, %g].' %
+            (path, regBounds[0], regBounds[-1]))
+
+    masses = counts / np.sum(counts)
+
+    if multiplexed:
+        qc, a, c = encodeMassesMultiplexed(masses)
     else:
-        resultsY.append(0)
+        qc, a, c = encodeMasses(masses)
+
+    return qc, a, c, regBounds
+
+
+def exactRegionProbabilities(qc, a, numQubits):
+    """
+    Computes the exact probability of every region from the statevector of
+    a circuit built by encodeDist or encodeDistMultiplexed, without any
+    shots. The region qubits are the last numQubits qubits of register a,
+    and every other qubit is marginalised out. Returns an array whose entry
+    j is the probability of region j.
+    """
+    circuit = qc.remove_final_measurements(inplace=False)
+    qubits = [circuit.qubits.index(q) for q in a[len(a) - numQubits:]]
+    return Statevector.from_instruction(circuit).probabilities(qubits)
 
-truthDisc = [integrate(distribution, regBounds[i], regBounds[i + 1]) * shots for i in range(
-    len(regBounds) - 1)]
 
-plt.figure(figsize=[16, 9])
-plt.plot(resultsX, resultsY)
-plt.plot(resultsX, truthDisc, '--')
-plt.show()
-print(results)
+def compareToMasses(probs, masses):
+    """
+    Compares the region probabilities of an encoded state to the masses of
+    the discretized distribution. Returns the maximum absolute error and
+    the KL divergence of the encoded probabilities from the normalised
+    masses.
+    """
+    truth = np.asarray(masses, dtype=float)
+    truth = truth / np.sum(truth)
+    probs = np.asarray(probs, dtype=float)
+    support = truth > 0
+
+    if np.any(probs[support] <= 0):
+        divergence = np.inf
+    else:
+        divergence = np.sum(truth[support] *
+            np.log(truth[support] / probs[support]))
+
+    return {
+        'maxAbsError': np.max(np.abs(probs - truth)),
+        'klDivergence': divergence
+    }
+
+
+def sampleRegions(probs, shots, seed=None):
+    """
+    Draws shots samples from the exact region probabilities with a single
+    multinomial draw, and returns them in the same form as the counts of a
+    qiskit result, keyed by the padded binary string of each region.
+    """
+    probs = np.asarray(probs, dtype=float)
+    numQubits = int(log2(len(probs)))
+    counts = np.random.RandomState(seed).multinomial(shots,
+        probs / np.sum(probs))
+    return {pad(bin(j), numQubits): int(count)
+        for j, count in enumerate(counts) if count}
+
+
+if __name__ == '__main__':
+    regBounds = [i for i in range(-16, 17)]
+    qc, a, c = encodeDist(distribution, regBounds)
+    numQubits = (qc.num_qubits + 2) // 2
+    masses = computeRegionMasses(distribution, regBounds)
+    shots = 100000
+
+    # Set to False to sample by running the circuit on a backend instead
+    exactMode = True
+
+    if exactMode:
+        probs = exactRegionProbabilities(qc, a, numQubits)
+        print(compareToMasses(probs, masses))
+        results = sampleRegions(probs, shots)
+    else:
+        for i in range(numQubits - 2, 2 * numQubits - 2):
+            qc.measure(a[i], c[i - (numQubits - 2)])
+
+        backend = Aer.get_backend('qasm_simulator')
+        job = cachedExecute(qc, backend, shots=shots)
+        results = job.result().get_counts()
+
+    resultsX = []
+    resultsY = []
+
+    for i in [pad(bin(x), numQubits) for x in range(2 ** (numQubits))]:
+        resultsX.append(i)
+        if i in results.keys():
+            resultsY.append(results[i])
+        else:
+            resultsY.append(0)
+
+    truthDisc = masses * shots
+
+    plt.figure(figsize=[16, 9])
+    plt.plot(resultsX, resultsY)
+    plt.plot(resultsX, truthDisc, '--')
+    plt.show()
+    print(results)
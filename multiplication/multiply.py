@@ -5,10 +5,15 @@ multiply.py: Multiply two numbers using repeated fourier
                transform based addition.
 """
 
+import os
+import sys
 from qiskit import QuantumRegister, QuantumCircuit, ClassicalRegister
-from qiskit import Aer, execute
+from qiskit import Aer
 from math import pi
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qexecute import cachedExecute
+
 def createInputState(qc, reg, n, pie):
     """
     Computes the quantum Fourier transform of reg, one qubit at
@@ -106,12 +111,12 @@ while(int(multiplier_str) != 0):
     add(multiplier, d, circ, -1)
     for i in range(len(multiplier)):
         circ.measure(multiplier[i], cl[i])
-    result = execute(circ, backend=Aer.get_backend('qasm_simulator'),
+    result = cachedExecute(circ, Aer.get_backend('qasm_simulator'),
                     shots=2).result().get_counts(circ.name)
     multiplier_str = list(result.keys())[0]
 
 circ.measure(accumulator, cl)
-result = execute(circ, backend=Aer.get_backend('qasm_simulator'),
+result = cachedExecute(circ, Aer.get_backend('qasm_simulator'),
             shots=2).result().get_counts(circ.name)
 
 print(result)
@@ -0,0 +1,115 @@
+"""
+benchmark.py: compares rejection sampling of the bayesian network in
+qbayes.py on a quantum simulator, with and without amplitude amplification,
+against vectorized ancestral sampling on a classical computer. For every
+number of samples it reports the samples drawn and accepted per second and
+the error of the estimated posterior against exact inference by variable
+elimination, and writes the results to a JSON or CSV file.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from qiskit import Aer
+import numpy as np
+
+from qbayes import exampleNetwork, nodeIndex, compileNetwork, drawSamples
+from qbayes import rejectionSample, eliminateVariables, ancestralSample
+from qbayes import matchesEvidence
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchresults import writeResults
+
+
+def classicalSampler(network, evidence):
+    """
+    Returns a function that draws the given number of samples with
+    ancestralSample and returns those that agree with the evidence.
+    """
+    def sample(n_samples):
+        values = ancestralSample(network, n_samples)
+        return values[matchesEvidence(values, network, evidence)]
+    return sample
+
+
+def quantumSampler(network, evidence, backend, iterations=None):
+    """
+    Compiles network and returns a function that draws the given number of
+    samples from the circuit and returns those that agree with the
+    evidence, along with the number of amplitude amplification rounds.
+    """
+    circ, iterations = compileNetwork(network, evidence, iterations)
+
+    def sample(n_samples):
+        return rejectionSample(drawSamples(circ, backend, n_samples),
+                               network, evidence)
+    return sample, iterations
+
+
+def runBenchmark(backend, sampleCounts, repeats, query, value, evidence,
+                 network=exampleNetwork):
+    """
+    Estimates P(query = value | evidence) with every sampler and number of
+    samples, repeats times each, and returns a list of dictionaries holding
+    the median rates and the mean absolute error of the estimates.
+    """
+    exact = eliminateVariables(network, query, evidence)[value]
+    column = nodeIndex(network, query)
+
+    amplified, iterations = quantumSampler(network, evidence, backend)
+    plain, _ = quantumSampler(network, evidence, backend, iterations=0)
+    samplers = [
+        ('classical', 0, classicalSampler(network, evidence)),
+        ('quantum', 0, plain),
+        ('quantumAmplified', iterations, amplified)
+    ]
+    results = []
+
+    for n_samples in sampleCounts:
+        for name, rounds, sample in samplers:
+            times = []
+            accepted = []
+            errors = []
+
+            for _ in range(repeats):
+                start = time.perf_counter()
+                samples = sample(n_samples)
+                times.append(time.perf_counter() - start)
+                accepted.append(len(samples))
+
+                if len(samples):
+                    estimate = np.mean(samples[:, column] == value)
+                    errors.append(abs(estimate - exact))
+
+            elapsed = float(np.median(times))
+            row = {
+                'sampler': name,
+                'iterations': rounds,
+                'samples': n_samples,
+                'samplesPerSecond': n_samples / elapsed,
+                'acceptedPerSecond': float(np.median(accepted)) / elapsed,
+                'acceptanceRate': float(np.mean(accepted)) / n_samples,
+                'exact': float(exact),
+                'meanAbsError': float(np.mean(errors)) if errors else None
+            }
+            print(row)
+            results.append(row)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark quantum and classical sampling of qbayes.py.')
+    parser.add_argument('--backend', default='qasm_simulator')
+    parser.add_argument('--samples', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    results = runBenchmark(Aer.get_backend(args.backend), args.samples,
+                           args.repeats, 'H', 0, {'P': 1})
+    writeResults(results, args.output)
@@ -1,14 +1,20 @@
 """
-qbayes.py: implements a simple bayesian network on a quantum computer and performs quantum rejection
-sampling.
+qbayes.py: compiles bayesian networks given by their probability tables into quantum circuits, and
+performs quantum rejection sampling, using amplitude amplification to make the evidence more likely.
 """
 
+import os
+import sys
 from qiskit import QuantumRegister, ClassicalRegister 
 from qiskit import QuantumCircuit, Aer
-from qiskit import execute
+from qiskit.circuit.library.standard_gates import RYGate, ZGate
 from math import pi
 
 from numpy import arcsin, sqrt
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qexecute import cachedExecute
 
 def probToAngle(prob):
     """
@@ -17,107 +23,297 @@ def probToAngle(prob):
     return 2*arcsin(sqrt(prob))
 
 
-def oracle(circ):
+def nodeIndex(network, name):
     """
-    Implements an oracle that flips the sign of states that contain P = 1.
+    Returns the position of the node called name in network.
     """
-    circ.cu3(pi, pi, 0, net[0], net[1])
-    circ.cu3(pi, pi, 0, net[0], net[1])    
-    return circ
+    return [node[0] for node in network].index(name)
+
+
+def prepareNetwork(network):
+    """
+    Builds the circuit that loads the joint distribution of a Bayesian
+    network into one qubit per node. network is a list of (name, parents,
+    cpt) tuples in topological order, where cpt lists P(node = 1) for every
+    row of the conditional probability table, reading the parent values as
+    a binary number with the first parent as the most significant bit.
+
+    Root nodes get a single RY rotation. Every row of the table of a node
+    with parents is applied as an RY rotation controlled on all of them,
+    with the parents that are 0 in that row flipped around it.
+    """
+    net = QuantumRegister(len(network), 'qreg')
+    prep = QuantumCircuit(net, name='prep')
+
+    for i, (name, parents, cpt) in enumerate(network):
+        controls = [net[nodeIndex(network, parent)] for parent in parents]
+
+        if not controls:
+            prep.ry(probToAngle(cpt[0]), net[i])
+            continue
 
+        for row, prob in enumerate(cpt):
+            flips = [controls[k] for k in range(len(controls))
+                     if not (row >> (len(controls) - 1 - k)) & 1]
 
-def u_gate(circ):
-    """
-    Implements the U gate that flips states about the average amplitude.
-    """
-    # Implements the quantum circuit that converts ψ -> |000...0>
-    circ.u3(-1*probToAngle(0.35), 0, 0, net[0])
-    circ.u3(-1*probToAngle(0.76), 0, 0, net[1])
-    circ.u3(-1*probToAngle(0.39), 0, 0, net[2])
-
-    # Flipping the |000...0> state using a triple controlled Z gate condtioned on P, E and H, 
-    # and applied to the ancilla
-    circ.x(net)
-    circ.cu1(pi/4, net[0], net[3])
-    circ.cx(net[0], net[1])
-    circ.cu1(-pi/4, net[1], net[3])
-    circ.cx(net[0], net[1])
-    circ.cu1(pi/4, net[1], net[3])
-    circ.cx(net[1], net[2])
-    circ.cu1(-pi/4, net[2], net[3])
-    circ.cx(net[0], net[2])
-    circ.cu1(pi/4, net[2], net[3])
-    circ.cx(net[1], net[2])
-    circ.cu1(-pi/4, net[2], net[3])
-    circ.cx(net[0], net[2])
-    circ.cu1(pi/4, net[2], net[3])
-    circ.x(net)
-
-    # Implements the quantum circuit that converts |000...0> -> ψ 
-    circ.u3(probToAngle(0.35), 0, 0, net[0])
-    circ.u3(probToAngle(0.76), 0, 0, net[1])
-    circ.u3(probToAngle(0.39), 0, 0, net[2])
+            for qubit in flips:
+                prep.x(qubit)
+            prep.append(RYGate(probToAngle(prob)).control(len(controls)),
+                        controls + [net[i]])
+            for qubit in flips:
+                prep.x(qubit)
+
+    return prep
+
+
+def phaseFlip(circ, qubits, values):
+    """
+    Flips the sign of the states in which qubits hold the given values.
+    """
+    flips = [qubit for qubit, value in zip(qubits, values) if not value]
+
+    for qubit in flips:
+        circ.x(qubit)
+    if len(qubits) == 1:
+        circ.z(qubits[0])
+    else:
+        circ.append(ZGate().control(len(qubits) - 1), qubits)
+    for qubit in flips:
+        circ.x(qubit)
 
     return circ
 
 
-# Create one 4 qubit QuantumRegister to hold the Bayesian network and an ancilla qubit,
-# and a 3 bit ClassicalRegister to hold the sampled values
-net = QuantumRegister(4, 'qreg')
-cl = ClassicalRegister(3, 'creg')
+def nodeFactor(network, i):
+    """
+    Returns the conditional probability table of node i as a factor: the
+    list of nodes it depends on, its parents followed by the node itself,
+    and an array with one axis of length 2 per node in that list.
+    """
+    name, parents, cpt = network[i]
+    probs = np.asarray(cpt, dtype=float).reshape([2] * len(parents))
+    nodes = [nodeIndex(network, parent) for parent in parents] + [i]
+    return nodes, np.stack([1 - probs, probs], axis=-1)
+
+
+def jointDistribution(network):
+    """
+    Returns the joint distribution of network as an array with one axis of
+    length 2 per node, in the order of network.
+    """
+    operands = []
+    for i in range(len(network)):
+        nodes, factor = nodeFactor(network, i)
+        operands += [factor, nodes]
+    return np.einsum(*operands, list(range(len(network))))
+
+
+def evidenceProbability(network, evidence):
+    """
+    Returns the prior probability of the evidence, a dictionary mapping
+    node names to their observed values.
+    """
+    joint = jointDistribution(network)
+    index = [slice(None)] * len(network)
+    for name, value in evidence.items():
+        index[nodeIndex(network, name)] = value
+    return np.sum(joint[tuple(index)])
+
 
-circ = QuantumCircuit(net, cl, name='circ')
+def groverIterations(prob):
+    """
+    Returns the number of amplitude amplification rounds k that maximises
+    the probability sin^2((2k + 1) theta) of observing the evidence, where
+    sin^2(theta) is its prior probability prob.
+    """
+    if prob <= 0:
+        raise ValueError('The evidence has zero probability.')
+
+    theta = arcsin(sqrt(min(prob, 1)))
+    k = max(int(np.floor(pi / (4 * theta) - 0.5)), 0)
+    return max([k, k + 1], key=lambda j: np.sin((2 * j + 1) * theta) ** 2)
+
+
+def compileNetwork(network, evidence=None, iterations=None):
+    """
+    Compiles a Bayesian network, given in the format taken by
+    prepareNetwork, into a circuit that samples it, with node i measured
+    into bit i. If evidence is given, amplitude amplification is applied
+    to the states that agree with it: each round flips their sign and then
+    reflects about the prepared state. Unless iterations is given, the
+    number of rounds is chosen by groverIterations from the prior
+    probability of the evidence.
+
+    Returns the circuit along with the number of rounds used.
+    """
+    net = QuantumRegister(len(network), 'qreg')
+    cl = ClassicalRegister(len(network), 'creg')
+    circ = QuantumCircuit(net, cl, name='circ')
 
-# Setting up a qubit to represent the variable P
-circ.u3(probToAngle(0.35), 0, 0, net[0])
+    prep = prepareNetwork(network)
+    circ.append(prep.to_instruction(), net[:])
 
-# Since we have P = 1, we use the second row of the probability table for the variable E
-circ.u3(probToAngle(0.76), 0, 0, net[1])
+    if evidence:
+        if iterations is None:
+            iterations = groverIterations(
+                evidenceProbability(network, evidence))
 
-# Setting up the qubit representing H assuming that E = 0
-circ.u3(probToAngle(0.39), 0, 0, net[2])
+        qubits = [net[nodeIndex(network, name)] for name in evidence]
 
-# Apply oracle and U gate twice
-circ = oracle(circ)
-circ = u_gate(circ)
-circ = oracle(circ)
-circ = u_gate(circ)
-circ.x(net[0])
+        for _ in range(iterations):
+            phaseFlip(circ, qubits, list(evidence.values()))
+            circ.append(prep.inverse().to_instruction(), net[:])
+            phaseFlip(circ, net[:], [0] * len(network))
+            circ.append(prep.to_instruction(), net[:])
+    else:
+        iterations = 0
 
-# Measure E, and rotate H to the P(1) value in the second row of the P(H|E) table condtioned on E
-circ.measure(net[1], cl[1])
-circ.u3(probToAngle(0.82) - probToAngle(0.39), 0, 0, net[2]).c_if(cl, 2)
+    circ.measure(net, cl)
+
+    return circ, iterations
+
+
+def eliminateVariables(network, query, evidence=None):
+    """
+    Computes the exact distribution of the node called query given the
+    evidence by variable elimination. The evidence is substituted into the
+    factors of every node, and the remaining nodes are summed out one at a
+    time, each time choosing the node whose elimination creates the
+    smallest factor. Returns the array [P(query = 0 | e), P(query = 1 | e)].
+    """
+    evidence = evidence or {}
+    observed = {nodeIndex(network, name): value
+                for name, value in evidence.items()}
+    target = nodeIndex(network, query)
+    factors = []
+
+    for i in range(len(network)):
+        nodes, factor = nodeFactor(network, i)
+        index = tuple(observed.get(node, slice(None)) for node in nodes)
+        factors.append(([node for node in nodes if node not in observed],
+                        factor[index]))
+
+    if target in observed:
+        dist = np.zeros(2)
+        dist[observed[target]] = 1
+        return dist
+
+    remaining = set(node for nodes, _ in factors for node in nodes)
+    remaining.discard(target)
+
+    while remaining:
+        node = min(remaining, key=lambda n: len(set().union(
+            *[nodes for nodes, _ in factors if n in nodes])))
+        used = [f for f in factors if node in f[0]]
+        factors = [f for f in factors if node not in f[0]]
+
+        kept = sorted(set().union(*[nodes for nodes, _ in used]) - {node})
+        operands = []
+        for nodes, factor in used:
+            operands += [factor, nodes]
+        factors.append((kept, np.einsum(*operands, kept)))
+        remaining.discard(node)
+
+    operands = []
+    for nodes, factor in factors:
+        operands += [factor, nodes]
+    dist = np.einsum(*operands, [target])
+    return dist / np.sum(dist)
+
+
+def ancestralSample(network, n_samples, seed=None):
+    """
+    Draws n_samples samples from the joint distribution of network on a
+    classical computer, sampling every node for all the samples at once
+    given the values already drawn for its parents. Returns an array
+    holding the value of node i in column i.
+    """
+    rng = np.random.RandomState(seed)
+    values = np.zeros((n_samples, len(network)), dtype=int)
+
+    for i, (name, parents, cpt) in enumerate(network):
+        row = np.zeros(n_samples, dtype=int)
+        for parent in parents:
+            row = 2 * row + values[:, nodeIndex(network, parent)]
+        values[:, i] = rng.random_sample(n_samples) < np.asarray(cpt)[row]
+
+    return values
+
+
+def matchesEvidence(values, network, evidence):
+    """
+    Returns a boolean array marking the samples in values, with node i in
+    column i, that agree with the evidence.
+    """
+    accepted = np.ones(len(values), dtype=bool)
+
+    for name, value in evidence.items():
+        accepted &= values[:, nodeIndex(network, name)] == value
+
+    return accepted
+
+
+def drawSamples(circ, backend, n_samples):
+    """
+    Runs circ for n_samples shots with per-shot memory and returns the
+    outcome of every shot as an array of bit strings, with bit i last.
+    The shots are split over as few jobs as the backend allows.
+    """
+    max_shots = getattr(backend.configuration(), 'max_shots', 0) or n_samples
+    memory = []
+
+    for start in range(0, n_samples, max_shots):
+        job = cachedExecute(circ, backend,
+                            shots=min(max_shots, n_samples - start),
+                            memory=True)
+        memory += job.result().get_memory(circ)
+
+    return np.array(memory)
+
+
+def rejectionSample(samples, network, evidence):
+    """
+    Converts the bit strings drawn from a circuit built by compileNetwork
+    into an array holding the value of node i in column i, and keeps only
+    the samples that agree with the evidence.
+    """
+    values = samples.astype('U%d' % len(network)).view('U1').reshape(
+        -1, len(network))[:, ::-1] == '1'
+    return values[matchesEvidence(values, network, evidence)].astype(int)
 
-# Sample by measuring the rest of the qubits
-circ.measure(net[0], cl[0])
-circ.measure(net[2], cl[2])
 
-# Get backend from Aer provider
-backend = Aer.get_backend('qasm_simulator')
+# The network P -> E -> H, with the P(1) value of every row of each
+# probability table. The first row of P(E|P) does not affect
+# P(H = 0 | P = 1), and only sets how rare the evidence P = 1 is.
+exampleNetwork = [
+    ('P', [], [0.35]),
+    ('E', ['P'], [0.5, 0.76]),
+    ('H', ['E'], [0.39, 0.82])
+]
 
-# Run job many times to get multiple samples
-samples_list = []
-n_samples = 500
 
-for i in range(n_samples):
-    job = execute(circ, backend=backend, shots=1)
-    result = list(job.result().get_counts(circ).keys())[0]
-    if result[2] == '1':
-        samples_list.append(result)
+if __name__ == '__main__':
+    network = exampleNetwork
+    evidence = {'P': 1}
 
-# Printing the number of useful samples and percentage of samples rejected
-print()
-print(n_samples, 'samples drawn:', len(samples_list), 'samples accepted,', n_samples-len(samples_list), 'samples rejected.' )
-print('Percentage of samples accepted: ', 100*((len(samples_list)/n_samples)), '%')
+    circ, iterations = compileNetwork(network, evidence)
+    print('Amplitude amplification rounds:', iterations)
 
-# Computing P(H = 0| P = 1)
-p_H = 0
+    # Get backend from Aer provider
+    backend = Aer.get_backend('qasm_simulator')
 
-for i in samples_list:
-    if i[0] == '0':
-        p_H += 1
+    # Draw all the samples in a single job and reject those without P = 1
+    n_samples = 500
+    samples_list = rejectionSample(drawSamples(circ, backend, n_samples),
+                                   network, evidence)
 
-p_H /= len(samples_list)
+    # Printing the number of useful samples and percentage of samples rejected
+    print()
+    print(n_samples, 'samples drawn:', len(samples_list), 'samples accepted,', n_samples-len(samples_list), 'samples rejected.' )
+    print('Percentage of samples accepted: ', 100*((len(samples_list)/n_samples)), '%')
 
-print('P(H = 0| P = 1) =', p_H)
-print()
+    # Computing P(H = 0| P = 1)
+    p_H = np.mean(samples_list[:, nodeIndex(network, 'H')] == 0)
+    print('P(H = 0| P = 1) =', p_H)
+    print('Exact value:', eliminateVariables(network, 'H', evidence)[0])
+    print()
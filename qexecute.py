@@ -0,0 +1,167 @@
+"""
+qexecute.py: a drop-in replacement for qiskit's execute() that avoids
+transpiling the same circuit structure over and over again.
+
+Transpiled circuits are cached per backend, keyed by the structure of the
+circuit. A circuit that has been seen before is not transpiled again, and
+a circuit that extends one seen before only has the new instructions
+transpiled. Parametrized templates are transpiled once and then only have
+their parameters bound.
+"""
+
+from qiskit import QuantumCircuit, transpile, assemble
+from qiskit.circuit import Instruction, ParameterExpression
+from qiskit.circuit.library import standard_gates
+import numpy as np
+
+# Maximum number of transpiled circuits kept for every backend
+cacheSize = 256
+
+# Transpiled circuits, keyed by backend name and then by circuit structure
+transpiledCircuits = {}
+
+# Gates that are fully described by their name, parameters and operands
+standardGates = tuple(gate for gate in vars(standard_gates).values()
+                      if isinstance(gate, type) and
+                      issubclass(gate, Instruction))
+
+
+def paramKey(param):
+    """
+    Returns a hashable key for a gate parameter, made only of plain Python
+    values so that keys can always be compared with ==. Real numbers,
+    including NumPy scalars and bound expressions, are keyed by their float
+    value. Unbound parameters are keyed by identity, since two Parameters
+    with the same name are not interchangeable when binding.
+    """
+    if isinstance(param, ParameterExpression):
+        if param.parameters:
+            return ('expression', str(param),
+                    tuple(sorted(id(p) for p in param.parameters)))
+        param = complex(param)
+    if isinstance(param, np.ndarray):
+        return ('array', param.shape, str(param.dtype), param.tobytes())
+    if isinstance(param, (complex, np.complexfloating)):
+        if param.imag:
+            return ('complex', float(param.real), float(param.imag))
+        param = param.real
+    if isinstance(param, (int, float, np.integer, np.floating)):
+        return float(param)
+    return ('value', type(param).__name__, str(param))
+
+
+def instructionKey(inst):
+    """
+    Returns a hashable key for a single instruction: its name and
+    parameters, and, unless it is one of qiskit's standard gates, the key
+    of its definition. Gates built with to_gate() or to_instruction() carry
+    no parameters once bound, so only their definition tells them apart.
+    """
+    key = (inst.name, tuple(paramKey(param) for param in inst.params))
+
+    if not isinstance(inst, standardGates):
+        definition = inst.definition
+        if definition is not None:
+            key += (circuitKey(definition),)
+
+    return key
+
+
+def circuitKey(circuit):
+    """
+    Returns a hashable key describing the structure of circuit: the sizes
+    of its registers, and every instruction along with its parameters,
+    definition, operands and classical condition.
+    """
+    qubits = {qubit: i for i, qubit in enumerate(circuit.qubits)}
+    clbits = {clbit: i for i, clbit in enumerate(circuit.clbits)}
+    registers = (tuple(len(reg) for reg in circuit.qregs),
+                 tuple(len(reg) for reg in circuit.cregs))
+    instructions = []
+
+    for inst, qargs, cargs in circuit.data:
+        condition = None
+        if inst.condition is not None:
+            target, value = inst.condition
+            if target in clbits:
+                condition = ('clbit', clbits[target], value)
+            else:
+                condition = ('register', circuit.cregs.index(target), value)
+        instructions.append((
+            instructionKey(inst),
+            tuple(qubits[qubit] for qubit in qargs),
+            tuple(clbits[clbit] for clbit in cargs),
+            condition
+        ))
+
+    return registers, tuple(instructions)
+
+
+def transpileCached(circuit, backend):
+    """
+    Returns circuit transpiled for backend, reusing earlier work. If a
+    circuit with the same structure has been transpiled before, a copy of
+    it is returned. Otherwise, on backends without a coupling map, the
+    longest cached prefix of the circuit is reused and only the remaining
+    instructions are transpiled.
+    """
+    backendCache = transpiledCircuits.setdefault(backend.name(), {})
+    key = circuitKey(circuit)
+
+    if key not in backendCache:
+        registers, instructions = key
+        prefixLength = 0
+        prefix = None
+
+        if backend.configuration().coupling_map is None:
+            for (cachedRegisters, cachedInstructions), cached in \
+                    backendCache.items():
+                length = len(cachedInstructions)
+                if cachedRegisters == registers and \
+                        prefixLength < length < len(instructions) and \
+                        instructions[:length] == cachedInstructions:
+                    prefixLength = length
+                    prefix = cached
+
+        if prefix is None:
+            backendCache[key] = transpile(circuit, backend)
+        else:
+            suffix = QuantumCircuit(*circuit.qregs, *circuit.cregs)
+            for inst, qargs, cargs in circuit.data[prefixLength:]:
+                suffix.append(inst, qargs, cargs)
+            backendCache[key] = prefix.compose(transpile(suffix, backend))
+
+        if len(backendCache) > cacheSize:
+            del backendCache[next(iter(backendCache))]
+
+    transpiled = backendCache[key].copy()
+    transpiled.name = circuit.name
+    return transpiled
+
+
+def cachedExecute(experiments, backend, shots=1024, **runOptions):
+    """
+    Runs a circuit, or a list of circuits, on backend as a single job and
+    returns the job, like execute(). Transpilation goes through
+    transpileCached. Any extra keyword arguments, such as memory, are
+    passed on to assemble().
+    """
+    if isinstance(experiments, QuantumCircuit):
+        experiments = [experiments]
+
+    circuits = [transpileCached(circuit, backend) for circuit in experiments]
+    return backend.run(assemble(circuits, backend, shots=shots,
+                                **runOptions))
+
+
+def executeTemplate(template, bindings, backend, shots=1024, **runOptions):
+    """
+    Transpiles the parametrized circuit template once, binds every
+    dictionary of parameter values in bindings to the transpiled circuit,
+    and runs all the bound circuits on backend as a single job. Returns
+    the job, whose results are in the same order as bindings.
+    """
+    transpiled = transpileCached(template, backend)
+    circuits = [transpiled.bind_parameters(binding) for binding in bindings]
+    return backend.run(assemble(circuits, backend, shots=shots,
+                                **runOptions))
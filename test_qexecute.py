@@ -0,0 +1,69 @@
+"""
+test_qexecute.py: checks that circuits run through the transpile cache in
+qexecute.py give the same results as the circuits they were built from.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('qiskit_aer')
+from qiskit import Aer, QuantumCircuit
+from qiskit.circuit import Parameter
+
+root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(root, 'qbayes'))
+from qexecute import cachedExecute, executeTemplate, transpiledCircuits
+from qbayes import exampleNetwork, compileNetwork, drawSamples
+from qbayes import rejectionSample, eliminateVariables, nodeIndex
+
+
+@pytest.fixture
+def backend():
+    transpiledCircuits.clear()
+    return Aer.get_backend('qasm_simulator')
+
+
+def test_same_shaped_networks_sample_their_own_circuits(backend):
+    """
+    Two networks with the same shape compile to circuits that differ only
+    inside their prep instructions, which must not share a cache entry.
+    """
+    evidence = {'P': 1}
+    other = [('P', [], [0.3]), ('E', ['P'], [0.5, 0.1]),
+             ('H', ['E'], [0.05, 0.95])]
+
+    for network in [exampleNetwork, other]:
+        circ, _ = compileNetwork(network, evidence)
+        samples = rejectionSample(drawSamples(circ, backend, 20000),
+                                  network, evidence)
+        estimate = np.mean(samples[:, nodeIndex(network, 'H')] == 0)
+        exact = eliminateVariables(network, 'H', evidence)[0]
+        assert abs(estimate - exact) < 4 * np.sqrt(0.25 / len(samples))
+
+
+def test_clbit_condition(backend):
+    qc = QuantumCircuit(2, 2)
+    qc.x(0)
+    qc.measure(0, 0)
+    qc.x(1).c_if(qc.clbits[0], 1)
+    qc.measure(1, 1)
+    assert cachedExecute(qc, backend).result().get_counts() == {'11': 1024}
+
+
+def test_concrete_circuit_after_template(backend):
+    """
+    Looking up a circuit with NumPy parameters must not fail when a shorter
+    template over the same registers is already cached.
+    """
+    theta = Parameter('theta')
+    template = QuantumCircuit(1, 1)
+    template.ry(theta, 0)
+    executeTemplate(template, [{theta: np.pi}], backend).result()
+
+    qc = QuantumCircuit(1, 1)
+    qc.ry(np.float64(np.pi), 0)
+    qc.measure(0, 0)
+    assert cachedExecute(qc, backend).result().get_counts() == {'1': 1024}